@@ -19,10 +19,14 @@ import re
 import sys
 import stat
 import time
+import mmap
 import signal
+import struct
 import gettext
-import subprocess
-from mudur_cgroupfs import Cgroupfs
+import threading
+from mudur_cgroupfs import Cgroupfs, ServiceCgroup
+from mudur_mounts import MOUNTS
+from mudur_watch import wait_socket
 
 ########
 # i18n #
@@ -48,7 +52,12 @@ def plymouth_update_milestone(function):
     """Updates plymouth milestones."""
     def wrapped():
         """Calls the function and updates plymouth milestone."""
+        previous = LOGGER.set_step(function.__name__)
+        span = TRACER.begin("step", function.__name__)
         function()
+        TRACER.end(span)
+        PROFILER.step_done(function.__name__)
+        LOGGER.set_step(previous)
         SPLASH.update(function.__name__)
     return wrapped
 
@@ -57,26 +66,14 @@ def plymouth_update_milestone(function):
 # Convenience methods #
 #######################
 
-def wait_bus(unix_name, timeout=5, wait=0.1, stream=True):
-    """Waits over a AF_UNIX socket for a given duration."""
-    import socket
-    itimeout = timeout
-    if stream:
-        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-    else:
-        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
-    while timeout > 0:
-        try:
-            sock.connect(unix_name)
-            LOGGER.debug("Waited %.2f sec for '%s'" \
-                    % (itimeout-timeout, unix_name))
-            return True
-        except socket.error:
-            timeout -= wait
-        time.sleep(wait)
-
-    LOGGER.debug("Waited %.2f seconds for '%s'" % (itimeout-timeout, unix_name))
-    return False
+def wait_bus(unix_name, timeout=5, stream=True):
+    """Waits until a AF_UNIX socket accepts connections for a given
+    duration, trying to connect only when the socket node changes."""
+    start = time.monotonic()
+    connected = wait_socket(unix_name, timeout, stream)
+    LOGGER.log("Waited %.3f sec for '%s'%s" % (time.monotonic() - start,
+            unix_name, "" if connected else ", timed out"))
+    return connected
 
 def load_file(path):
     """Reads the contents of a file and returns it."""
@@ -261,35 +258,516 @@ def kexec_halt():
 # Process spawning related methods #
 ####################################
 
+class Spawner:
+    """Spawns commands with posix_spawn, which avoids copying the page tables
+    of mudur like fork does, redirecting them to a pre-opened /dev/null."""
+
+    def __init__(self):
+        self.devnull = None
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def get_devnull(self):
+        """Returns the shared /dev/null descriptor."""
+        if self.devnull is None:
+            self.devnull = os.open("/dev/null", os.O_RDWR | os.O_CLOEXEC)
+        return self.devnull
+
+    def spawn(self, cmd, stdin=None, stdout=None, stderr=None):
+        """Spawns the command, the given descriptors replace the standard IO
+        channels of the child. Returns the pid."""
+        actions = [(os.POSIX_SPAWN_DUP2, fd, target) for target, fd in \
+                   ((0, stdin), (1, stdout), (2, stderr)) if fd is not None]
+        # Python ignores SIGPIPE and SIGXFSZ, children should not
+        pid = os.posix_spawnp(cmd[0], cmd, os.environ, file_actions=actions,
+                              setsigdef=(signal.SIGPIPE, signal.SIGXFSZ))
+        with self.lock:
+            self.count += 1
+        return pid
+
+    def wait(self, pid):
+        """Waits for the given child and returns its exit code."""
+        return os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1])
+
+    def call(self, cmd, stdout=None, stderr=None):
+        """Runs the command and returns its exit code."""
+        span = TRACER.begin("command", cmd)
+        ret = self.wait(self.spawn(cmd, stdout=stdout, stderr=stderr))
+        TRACER.end(span, ret)
+        return ret
+
+    def call_many(self, chains, jobs=8, stdout=None, stderr=None):
+        """Runs chains of commands, the commands of a chain one after another
+        and at most jobs chains at a time. Returns the exit codes and
+        durations of the commands of each chain in the given order."""
+        import select
+
+        jobs = max(1, jobs)
+        results = [[None] * len(chain) for chain in chains]
+        pending = [(index, 0) for index, chain in enumerate(chains) if chain]
+        running = {}
+        while pending or running:
+            while pending and len(running) < jobs:
+                index, position = pending.pop(0)
+                cmd = chains[index][position]
+                pid = self.spawn(cmd, stdout=stdout, stderr=stderr)
+                start = time.monotonic()
+                try:
+                    pidfd = os.pidfd_open(pid)
+                except (AttributeError, OSError):
+                    # Old kernel, wait for this one before the next
+                    results[index][position] = (self.wait(pid),
+                                                time.monotonic() - start)
+                    if position + 1 < len(chains[index]):
+                        pending.insert(0, (index, position + 1))
+                    continue
+                running[pidfd] = (index, position, pid, start)
+            if not running:
+                continue
+            # A pidfd becomes readable when the process exits
+            for pidfd in select.select(list(running), [], [])[0]:
+                index, position, pid, start = running.pop(pidfd)
+                os.close(pidfd)
+                results[index][position] = (self.wait(pid),
+                                            time.monotonic() - start)
+                # The next command of the chain goes before the other chains
+                if position + 1 < len(chains[index]):
+                    pending.insert(0, (index, position + 1))
+        return results
+
+    def capture(self, cmd, text=True):
+        """Runs the command and returns its stdout and stderr, as text
+        unless text is False."""
+        import select
+
+        span = TRACER.begin("command", cmd)
+        out_read, out_write = os.pipe()
+        err_read, err_write = os.pipe()
+        try:
+            pid = self.spawn(cmd, stdin=self.get_devnull(),
+                             stdout=out_write, stderr=err_write)
+        except OSError:
+            os.close(out_read)
+            os.close(err_read)
+            raise
+        finally:
+            os.close(out_write)
+            os.close(err_write)
+        output = {out_read: [], err_read: []}
+        fds = [out_read, err_read]
+        while fds:
+            for fd in select.select(fds, [], [])[0]:
+                data = os.read(fd, 65536)
+                if data:
+                    output[fd].append(data)
+                else:
+                    fds.remove(fd)
+                    os.close(fd)
+        ret = self.wait(pid)
+        TRACER.end(span, ret)
+        output = [b"".join(output[fd]) for fd in (out_read, err_read)]
+        if text:
+            output = [data.decode("utf-8", "replace") for data in output]
+        return tuple(output)
+
 def capture(*cmd):
     """Captures the output of a command without running a shell."""
-    process = subprocess.Popen(cmd,
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE)
-    return process.communicate()
+    return SPAWNER.capture(cmd)
 
 def run_async(cmd, stdout=None, stderr=None):
     """Runs a command in background and redirects the outputs optionally."""
     fstdout = stdout if stdout else "/dev/null"
     fstderr = stderr if stderr else "/dev/null"
     with open(fstdout, "w") as out_file, open(fstderr, "w") as err_file:
-        return subprocess.Popen(cmd,
-                                stdout=out_file,
-                                stderr=err_file).pid
+        return SPAWNER.spawn(cmd, stdout=out_file.fileno(),
+                             stderr=err_file.fileno())
 
 def run(*cmd):
     """Runs a command without running a shell, only output errors."""
-    with open("/dev/null", "w") as null_file:
-        return subprocess.call(cmd, stdout=null_file)
+    return SPAWNER.call(cmd, stdout=SPAWNER.get_devnull())
 
 def run_full(*cmd):
     """Runs a command without running a shell, with full output."""
-    return subprocess.call(cmd)
+    return SPAWNER.call(cmd)
 
 def run_quiet(*cmd):
     """Runs a command without running a shell and no output."""
-    with open("/dev/null", "w") as null_file:
-        return subprocess.call(cmd, stdout=null_file, stderr=null_file)
+    devnull = SPAWNER.get_devnull()
+    return SPAWNER.call(cmd, stdout=devnull, stderr=devnull)
+
+
+################
+# Tracer class #
+################
+
+class Tracer:
+    """Records boot steps and external commands as spans in the Chrome trace
+    event format which chrome://tracing and Perfetto can load."""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.events = []
+
+    def read_io(self):
+        """Returns the I/O counters of the calling thread, steps run
+        concurrently so the process counters would mix them."""
+        counters = {}
+        try:
+            with open(f"/proc/self/task/{threading.get_native_id()}/io") \
+                    as _file:
+                for line in _file:
+                    key, value = line.split(":")
+                    counters[key] = int(value)
+        except (OSError, ValueError):
+            pass
+        return counters
+
+    def begin(self, category, step_or_cmd):
+        """Starts a span for a step name or a command, returns None if
+        tracing is disabled."""
+        if not self.enabled:
+            return None
+        return (category, step_or_cmd, time.monotonic(),
+                time.clock_gettime(time.CLOCK_BOOTTIME),
+                time.thread_time(), os.times(), self.read_io())
+
+    def end(self, span, returncode=None):
+        """Finishes a span started with begin()."""
+        if span is None:
+            return
+        category, step_or_cmd, start, boottime, cpu, times, io_start = span
+        duration = time.monotonic() - start
+        now = os.times()
+        args = {
+            "monotonic": start,
+            "boottime": boottime,
+            "thread_cpu": time.thread_time() - cpu,
+            # Reaped children are only counted per process, so these include
+            # the commands of the steps running at the same time
+            "process_children_user": now.children_user - times.children_user,
+            "process_children_system": now.children_system - \
+                    times.children_system,
+        }
+        for key, value in self.read_io().items():
+            args[f"thread_{key}"] = value - io_start.get(key, 0)
+        if category == "command":
+            name = os.path.basename(step_or_cmd[0])
+            args["argv"] = list(step_or_cmd)
+            args["exit_code"] = returncode
+        else:
+            name = step_or_cmd
+        self.events.append({
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": boottime * 1000000,
+            "dur": duration * 1000000,
+            "pid": os.getpid(),
+            "tid": threading.get_native_id(),
+            "args": args,
+        })
+
+    def save(self, path="/run/mudur/trace.json"):
+        """Appends the recorded spans of this stage to the trace file."""
+        import json
+
+        if not self.enabled or not self.events:
+            return
+        trace = {"traceEvents": []}
+        try:
+            with open(path) as _file:
+                trace = json.load(_file)
+        except (OSError, ValueError):
+            pass
+        trace["traceEvents"].append({
+            "name": "process_name",
+            "ph": "M",
+            "pid": os.getpid(),
+            "args": {"name": f"mudur {sys.argv[1]}"},
+        })
+        trace["traceEvents"].extend(self.events)
+        try:
+            create_directory(os.path.dirname(path))
+            with open(f"{path}.tmp", "w") as _file:
+                json.dump(trace, _file)
+            os.rename(f"{path}.tmp", path)
+        except OSError:
+            LOGGER.log(f"Cannot write boot trace to {path}")
+        self.events = []
+
+
+####################
+# Step cache class #
+####################
+
+class StepCache:
+    """Persistent cache of step results keyed on a fingerprint of the
+    inputs of each step, so unchanged steps can be skipped or replayed."""
+
+    def __init__(self, path="/var/lib/mudur/steps.cache", enabled=True):
+        self.path = path
+        # When disabled, every step runs but the results are still stored
+        self.enabled = enabled
+        self.entries = None
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Loads the cache file once."""
+        import json
+
+        if self.entries is None:
+            try:
+                with open(self.path) as _file:
+                    self.entries = json.load(_file)
+            except (OSError, ValueError):
+                self.entries = {}
+
+    def fingerprint(self, files=(), extra=()):
+        """Returns a digest of the kernel release, mudur= options, the
+        extra values and the mtime, size and content of the files."""
+        import hashlib
+
+        digest = hashlib.sha1()
+        digest.update(os.uname()[2].encode())
+        options = get_kernel_option("mudur")
+        options.pop("nocache", None)
+        digest.update(repr(sorted(options.items())).encode())
+        digest.update(repr(list(extra)).encode())
+        for path in files:
+            digest.update(path.encode())
+            try:
+                info = os.stat(path)
+                digest.update(f"{info.st_mtime_ns}:{info.st_size}".encode())
+                with open(path, "rb") as _file:
+                    digest.update(hashlib.sha1(_file.read()).digest())
+            except OSError:
+                digest.update(b"missing")
+        return digest.hexdigest()
+
+    def lookup(self, step, fingerprint):
+        """Returns the cached result of the step or None."""
+        if not self.enabled:
+            return None
+        with self.lock:
+            self.load()
+            entry = self.entries.get(step)
+        if entry and entry["fingerprint"] == fingerprint:
+            LOGGER.debug(f"Step {step} is unchanged, using cached result")
+            return entry["result"]
+        return None
+
+    def store(self, step, fingerprint, result=True):
+        """Stores the result of the step, which must not be None."""
+        with self.lock:
+            self.load()
+            self.entries[step] = {"fingerprint": fingerprint,
+                                  "result": result}
+            self.dirty = True
+
+    def save(self):
+        """Writes the cache if some steps were stored."""
+        import json
+
+        if not self.dirty:
+            return
+        try:
+            create_directory(os.path.dirname(self.path))
+            with open(f"{self.path}.tmp", "w") as _file:
+                json.dump(self.entries, _file)
+            os.rename(f"{self.path}.tmp", self.path)
+            self.dirty = False
+        except OSError:
+            LOGGER.log(f"Cannot write step cache {self.path}")
+
+
+##################
+# Profiler class #
+##################
+
+class Profiler:
+    """Samples the stacks of all mudur threads on a wall-clock signal timer
+    and aggregates them into collapsed stacks for flamegraph tools."""
+
+    def __init__(self, interval=False, memory=False):
+        # interval is the mudur=profile option, True or milliseconds
+        self.enabled = interval is not False
+        self.interval = 0.01
+        if self.enabled and interval is not True:
+            try:
+                self.interval = float(interval) / 1000
+                if self.interval <= 0:
+                    raise ValueError(interval)
+            except ValueError:
+                print(f"Invalid profiling interval '{interval}'")
+                self.interval = 0.01
+        self.memory = self.enabled and memory
+        self.stacks = {}
+        self.peaks = []
+
+    def sample(self, signum, frame):
+        """Signal handler which records the current stack of each thread."""
+        for thread_id, top in sys._current_frames().items():
+            if thread_id == threading.main_thread().ident:
+                # Skip this handler, start from the interrupted frame
+                top = frame
+            names = []
+            while top is not None:
+                code = top.f_code
+                module = os.path.splitext(os.path.basename(code.co_filename))[0]
+                names.append(f"{module}:{code.co_name}")
+                top = top.f_back
+            stack = ";".join(reversed(names))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def start(self):
+        """Starts sampling if profiling is enabled."""
+        if not self.enabled:
+            return
+        if self.memory:
+            import tracemalloc
+            tracemalloc.start()
+        signal.signal(signal.SIGALRM, self.sample)
+        signal.setitimer(signal.ITIMER_REAL, self.interval, self.interval)
+
+    def step_done(self, step):
+        """Records the peak memory usage since the previous step, steps
+        running concurrently share the peak."""
+        if self.memory:
+            import tracemalloc
+            self.peaks.append((step, tracemalloc.get_traced_memory()[1]))
+            tracemalloc.reset_peak()
+
+    def save(self, directory="/run/mudur"):
+        """Stops sampling and writes the collapsed stacks of the stage."""
+        if not self.enabled:
+            return
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        # Saved once, see main
+        self.enabled = False
+        stage = sys.argv[1]
+        try:
+            create_directory(directory)
+            with open(os.path.join(directory, f"profile-{stage}.folded"),
+                      "w") as _file:
+                for stack, count in sorted(self.stacks.items()):
+                    _file.write(f"{stack} {count}\n")
+            if self.memory:
+                with open(os.path.join(directory, f"memory-{stage}.txt"),
+                          "w") as _file:
+                    for step, peak in self.peaks:
+                        _file.write(f"{step} {peak}\n")
+        except OSError:
+            LOGGER.log(f"Cannot write profile to {directory}")
+
+
+##################
+# Step scheduler #
+##################
+
+class Step:
+    """Dummy class to hold a boot step and its prerequisites. An exclusive
+    step runs alone, e.g. when it may take over the console."""
+
+    def __init__(self, name, function, requires=(), provides=(),
+                 exclusive=False):
+        self.name = name
+        self.function = function
+        self.exclusive = exclusive
+        self.requires = set(requires)
+        # A step always provides its own name so others can depend on it
+        self.provides = set(provides)
+        self.provides.add(name)
+
+
+class Scheduler:
+    """Runs boot steps on a bounded thread pool as soon as their
+    prerequisites are satisfied."""
+
+    def __init__(self, steps, jobs=1):
+        # The given order is also the serial fallback order
+        self.steps = steps
+        self.jobs = max(1, jobs)
+
+    def get_schedule(self, facts=()):
+        """Groups steps into waves which may run concurrently, returns None
+        if the prerequisites of some steps can never be satisfied."""
+        facts = set(facts)
+        pending = list(self.steps)
+        waves = []
+        while pending:
+            wave = [step for step in pending if step.requires <= facts]
+            if not wave:
+                return None
+            wave = self.get_launchable(wave, [])
+            for step in wave:
+                pending.remove(step)
+                facts.update(step.provides)
+            waves.append(wave)
+        return waves
+
+    def get_launchable(self, ready, running):
+        """Returns the ready steps which may be launched next to the running
+        ones, in the given order up to the first exclusive step."""
+        if any([step.exclusive for step in running]):
+            return []
+        launchable = []
+        for step in ready:
+            if step.exclusive:
+                if not running and not launchable:
+                    launchable.append(step)
+                break
+            launchable.append(step)
+        return launchable
+
+    def run_step(self, step):
+        """Runs a step, logging its messages with the step name."""
+        previous = LOGGER.set_step(step.name)
+        step.function()
+        LOGGER.set_step(previous)
+
+    def run_serial(self):
+        """Runs the steps one after another in the given order."""
+        LOGGER.log("Step schedule (serial): %s" % \
+                " -> ".join([step.name for step in self.steps]))
+        for step in self.steps:
+            self.run_step(step)
+
+    def run(self, facts=(), serial=False):
+        """Runs the steps, facts are the prerequisites already satisfied."""
+        from concurrent.futures import ThreadPoolExecutor, wait, \
+                FIRST_COMPLETED
+
+        waves = self.get_schedule(facts)
+        if waves is None:
+            LOGGER.log("Unsatisfiable step prerequisites, running serially")
+            serial = True
+
+        if serial or self.jobs == 1:
+            self.run_serial()
+            return
+
+        LOGGER.log("Step schedule (%d jobs): %s" % (self.jobs,
+                " -> ".join(["[%s]" % ", ".join([step.name for step in wave])
+                             for wave in waves])))
+
+        facts = set(facts)
+        pending = list(self.steps)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.jobs,
+                                thread_name_prefix="mudur") as executor:
+            while pending or running:
+                for step in self.get_launchable(
+                        [step for step in pending if step.requires <= facts],
+                        list(running.values())):
+                    pending.remove(step)
+                    running[executor.submit(self.run_step, step)] = step
+                done = wait(running, return_when=FIRST_COMPLETED)[0]
+                for future in done:
+                    step = running.pop(future)
+                    # Re-raises the exception of a failed step
+                    future.result()
+                    facts.update(step.provides)
 
 
 ################
@@ -297,30 +775,230 @@ def run_quiet(*cmd):
 ################
 
 class Logger:
-    """Logger class for dumping into /var/log/mudur.log."""
-    
-    def __init__(self):
-        self.lines = ["\n"]
+    """Logger class keeping structured records in a ring buffer, which is
+    mmap-backed in /run to survive crashes, and appending them to
+    /var/log/mudur.log from a background writer."""
+
+    HEADER = struct.Struct("<8sQQQ")
+    RECORD = struct.Struct("<IddB")
+    MAGIC = b"MUDURLOG"
+    LEVELS = ("info", "debug")
+    COLORS = re.compile(r"(\033.*?m)")
+
+    def __init__(self, size=262144):
+        self.size = size
+        # Anonymous memory until /run is available, see attach()
+        self.ring = mmap.mmap(-1, self.HEADER.size + self.size)
+        self.head = 0
+        self.tail = 0
+        self.lost = 0
+        self.stage = sys.argv[1] if len(sys.argv) > 1 else ""
+        self.context = threading.local()
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.writer = None
+        self.persistent = False
+        self.kmsg = None
+        self.path = "/var/log/mudur.log"
+        self.max_size = 1048576
+        self.rotations = 3
+
+    def _read(self, offset, length):
+        """Reads from the ring at the given absolute offset."""
+        pos = offset % self.size
+        first = min(length, self.size - pos)
+        data = self.ring[self.HEADER.size + pos:self.HEADER.size + pos + first]
+        if first < length:
+            data += self.ring[self.HEADER.size:
+                              self.HEADER.size + length - first]
+        return data
+
+    def _write(self, offset, data):
+        """Writes to the ring at the given absolute offset."""
+        pos = offset % self.size
+        first = min(len(data), self.size - pos)
+        self.ring[self.HEADER.size + pos:self.HEADER.size + pos + first] = \
+                data[:first]
+        if first < len(data):
+            self.ring[self.HEADER.size:
+                      self.HEADER.size + len(data) - first] = data[first:]
+
+    def _append(self, record):
+        """Appends a packed record, dropping the oldest ones if needed.
+        Must be called with the lock held."""
+        while self.head + len(record) - self.tail > self.size:
+            length = self.RECORD.unpack(
+                    self._read(self.tail, self.RECORD.size))[0]
+            self.tail += self.RECORD.size + length
+            self.lost += 1
+        self._write(self.head, record)
+        self.head += len(record)
+        self.HEADER.pack_into(self.ring, 0, self.MAGIC, self.size,
+                              self.head, self.tail)
+
+    def _records(self, start, end):
+        """Yields the offset and the packed records between offsets."""
+        while start < end:
+            length = self.RECORD.unpack(
+                    self._read(start, self.RECORD.size))[0]
+            yield start, self._read(start, self.RECORD.size + length)
+            start += self.RECORD.size + length
+
+    def attach(self, path="/run/mudur/log.ring"):
+        """Moves the ring buffer into a file so that it survives a crash,
+        adopting the unwritten records left in an existing one."""
+        total = self.HEADER.size + self.size
+        try:
+            create_directory(os.path.dirname(path))
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+            try:
+                if os.fstat(fd).st_size != total:
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, total)
+                ring = mmap.mmap(fd, total)
+            finally:
+                os.close(fd)
+        except OSError:
+            return False
 
-    def log(self, msg):
+        with self.lock:
+            records = [record for _, record in \
+                       self._records(self.tail, self.head)]
+            magic, size, head, tail = self.HEADER.unpack_from(ring)
+            if magic != self.MAGIC or size != self.size or tail > head:
+                head = tail = 0
+            self.ring.close()
+            self.ring, self.head, self.tail = ring, head, tail
+            for record in records:
+                self._append(record)
+        return True
+
+    def detach(self):
+        """Gives a forked child its own ring, so that it doesn't write into
+        the parent's. Locks held by the threads of the parent are dropped."""
+        self.ring = mmap.mmap(-1, self.HEADER.size + self.size)
+        self.head = self.tail = self.lost = 0
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.writer = None
+
+    def log(self, msg, level=0):
         """Logs the given message."""
-        stamp = time.strftime("%b %d %H:%M:%S")
-        # Strip color characters
-        msg = re.sub(r"(\033.*?m)", "", msg)
-        self.lines.append("[%.3f] %s %s\n" % (time.time(), stamp, msg))
+        step = getattr(self.context, "step", None) or ""
+        payload = f"{self.stage}\0{step}\0{msg}".encode("utf-8", "replace")
+        payload = payload[:self.size // 4]
+        record = self.RECORD.pack(len(payload), time.time(),
+                                  time.monotonic(), level) + payload
+        with self.lock:
+            self._append(record)
+        if not self.persistent:
+            self.mirror(msg)
+        self.wakeup.set()
 
     def debug(self, msg):
         """Log the message if debug is enabled."""
         if CONFIG.get("debug"):
-            self.log(msg)
+            self.log(msg, level=1)
+
+    def set_step(self, step):
+        """Sets the step of the calling thread, returns the previous one."""
+        previous = getattr(self.context, "step", None)
+        self.context.step = step
+        return previous
+
+    def mirror(self, msg):
+        """Mirrors the message to the kernel log while mudur.log is not
+        writable."""
+        if self.kmsg == -1:
+            return
+        if "\033" in msg:
+            msg = self.COLORS.sub("", msg)
+        try:
+            if self.kmsg is None:
+                self.kmsg = os.open("/dev/kmsg", os.O_WRONLY | os.O_CLOEXEC)
+            os.write(self.kmsg, f"<14>mudur: {msg}\n".encode("utf-8",
+                                                               "replace"))
+        except OSError:
+            self.kmsg = -1
+
+    def format(self, record):
+        """Returns the log file line of a packed record."""
+        length, wall, monotonic, level = self.RECORD.unpack_from(record)
+        stage, step, msg = record[self.RECORD.size:].decode(
+                "utf-8", "replace").split("\0", 2)
+        if "\033" in msg:
+            # Strip color characters
+            msg = self.COLORS.sub("", msg)
+        stamp = time.strftime("%b %d %H:%M:%S", time.localtime(wall))
+        where = f"{stage}/{step}" if step else stage
+        return "[%.3f] %s %s %s: %s\n" % (monotonic, stamp, where,
+                                          self.LEVELS[level], msg)
+
+    def rotate(self):
+        """Rotates the log file if it exceeds the maximum size."""
+        try:
+            if os.path.getsize(self.path) < self.max_size:
+                return
+        except OSError:
+            return
+        for index in range(self.rotations - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.rename(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        os.rename(self.path, f"{self.path}.1")
+
+    def write_pending(self):
+        """Appends the unwritten records to the log file."""
+        with self.write_lock:
+            with self.lock:
+                end = self.head
+                records = [record for _, record in \
+                           self._records(self.tail, end)]
+                lost, self.lost = self.lost, 0
+            if not records and not lost:
+                return
+            lines = [self.format(record) for record in records]
+            if lost:
+                lines.insert(0, f"[{lost} records lost]\n")
+            try:
+                self.rotate()
+                with open(self.path, "a") as _file:
+                    _file.writelines(lines)
+            except OSError:
+                self.persistent = False
+                with self.lock:
+                    self.lost += lost
+                raise
+            self.persistent = True
+            with self.lock:
+                # Records may have been dropped meanwhile
+                self.tail = max(self.tail, end)
+                self.HEADER.pack_into(self.ring, 0, self.MAGIC, self.size,
+                                      self.head, self.tail)
+
+    def writer_loop(self):
+        """Writes the records in background, batching them."""
+        while True:
+            self.wakeup.wait(5)
+            self.wakeup.clear()
+            time.sleep(0.5)
+            try:
+                self.write_pending()
+            except OSError:
+                pass
+
+    def start_writer(self):
+        """Starts the background writer once the log file is writable."""
+        if self.writer is None:
+            self.writer = threading.Thread(target=self.writer_loop,
+                                           name="mudur-log", daemon=True)
+            self.writer.start()
 
     def flush(self):
         """Flushes the log buffer."""
         try:
-            self.lines.append("\n")
-            with open("/var/log/mudur.log", "a") as _file:
-                _file.writelines(self.lines)
-            self.lines.clear()  # Clear lines after flushing to log
+            self.write_pending()
         except IOError:
             UI.error(_("Cannot write mudur.log, read-only file system"))
 
@@ -353,7 +1031,18 @@ class Config:
             "forcefsck": False,
             "head_start": "",
             "services": "",
+            "jobs": "4",
+            "service_jobs": "8",
+            "ready_timeout": "30",
+            "stop_timeout": "15",
+            "cgroups": "legacy",
+            "serial": False,
+            "trace": False,
+            "profile": False,
+            "memprofile": False,
+            "nocache": False,
         }
+        self.defaults = dict(self.options)
 
         # Load config file if exists
         if os.path.exists("/etc/conf.d/mudur"):
@@ -399,13 +1088,25 @@ class Config:
             print(f"Unknown option '{key}' requested")
             time.sleep(3)
 
-    def get_fstab_entry_with_mountpoint(self, mountpoint):
-        """Returns /etc/fstab entry corresponding to the given mountpoint."""
+    def get_int(self, key):
+        """Returns an integer option, or its default if it is malformed."""
+        try:
+            return int(self.get(key))
+        except (TypeError, ValueError):
+            print(f"Invalid value '{self.get(key)}' for option '{key}'")
+            return int(self.defaults[key])
+
+    def get_fstab_entries(self):
+        """Returns the fields of /etc/fstab entries, without comments."""
         if not self.fstab:
             data = load_file("/etc/fstab").split("\n")
-            self.fstab = [line.split() for line in data if line]
+            self.fstab = [line.split() for line in data \
+                          if line and not line.lstrip().startswith("#")]
+        return self.fstab
 
-        for entry in self.fstab:
+    def get_fstab_entry_with_mountpoint(self, mountpoint):
+        """Returns /etc/fstab entry corresponding to the given mountpoint."""
+        for entry in self.get_fstab_entries():
             if entry and len(entry) > 3 and entry[1] == mountpoint:
                 return entry
 
@@ -415,19 +1116,105 @@ class Config:
 ##################
 
 class Plymouth:
-    """Plymouth class for visualizing init messages and plymouth SPLASH."""
+    """Plymouth class for visualizing init messages and plymouth SPLASH.
+    Requests are queued and sent from a background thread over a single
+    connection to the daemon socket."""
+
+    SOCKET = "\0/org/freedesktop/plymouthd"
+    ACK = b"\x06"
 
     def __init__(self):
         """Plymouth constructor."""
-        self.client = "/bin/plymouth"
         self.daemon = "/sbin/plymouthd"
-        self.available = CONFIG.get("lxc_guest") != "yes" and os.path.exists(self.client)
-        self.running = self.available and not run_quiet(self.client, "--ping")
+        self.available = CONFIG.get("lxc_guest") != "yes" and os.path.exists(self.daemon)
+        self.sock = None
+        # False once connecting has failed, the daemon is not running
+        self.running = self.available
+        self.queue = []
+        self.busy = False
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def connect(self):
+        """Connects to the daemon socket, returns False if not running."""
+        import socket
+
+        if self.sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(5)
+            try:
+                sock.connect(self.SOCKET)
+            except OSError:
+                sock.close()
+                return False
+            self.sock = sock
+        return True
+
+    def disconnect(self):
+        """Closes the daemon connection."""
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def request(self, command, argument=None):
+        """Sends a request in the boot protocol of plymouth and returns True
+        if the daemon acknowledged it."""
+        if argument is None:
+            data = command + b"\0"
+        else:
+            data = command + b"\x02" + bytes([len(argument) + 1]) + \
+                   argument + b"\0"
+        for _attempt in range(2):
+            if not self.connect():
+                self.running = False
+                return False
+            try:
+                self.sock.sendall(data)
+                return self.sock.recv(1) == self.ACK
+            except OSError:
+                # The daemon may have restarted, reconnect once
+                self.disconnect()
+        return False
+
+    def sender(self):
+        """Background thread sending the queued requests."""
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.busy = False
+                    self.condition.notify_all()
+                    self.condition.wait()
+                command, argument = self.queue.pop(0)
+                self.busy = True
+            if self.running:
+                self.request(command, argument)
+                if command == b"Q":
+                    self.disconnect()
+
+    def send_cmd(self, command, argument=None):
+        """Queues a request for the daemon without waiting for it."""
+        if not self.running:
+            return
+        if isinstance(argument, str):
+            argument = argument.encode("utf-8", "replace")[:254]
+        with self.condition:
+            if command == b"U" and self.queue and self.queue[-1][0] == b"U":
+                # Only the latest status matters
+                self.queue[-1] = (command, argument)
+            else:
+                self.queue.append((command, argument))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.sender,
+                                               name="mudur-plymouth",
+                                               daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
 
-    def send_cmd(self, *cmd):
-        """Send the client a command to pass to the daemon."""
-        if self.running:
-            return run_quiet(self.client, *cmd)
+    def flush(self):
+        """Waits until the queued requests are sent."""
+        with self.condition:
+            while self.queue or self.busy:
+                self.condition.wait()
 
     def start_daemon(self):
         """Starts plymouth daemon."""
@@ -436,27 +1223,30 @@ class Plymouth:
 
     def show_splash(self):
         """Shows splash screen."""
-        self.send_cmd("show-splash")
+        self.send_cmd(b"$")
 
     def hide_splash(self):
         """Hides splash screen."""
-        self.send_cmd("hide-splash")
+        self.send_cmd(b"H")
+        # Console output follows
+        self.flush()
 
     def report_error(self):
         """Reports error."""
-        self.send_cmd("report-error")
+        self.send_cmd(b"!")
 
     def update(self, milestone):
         """Updates status milestones."""
-        self.send_cmd("update", f"--status={milestone}")
+        self.send_cmd(b"U", milestone)
 
     def rootfs_is_now_rw(self):
         """Notifies that rootfs is now rw."""
-        self.send_cmd("update-root-fs", "--read-write")
+        self.send_cmd(b"S")
 
     def quit(self, retain_splash=False):
         """Quits the daemon."""
-        self.send_cmd("quit", "--retain-splash" if retain_splash else "")
+        self.send_cmd(b"Q", b"\x01" if retain_splash else b"")
+        self.flush()
 
 
 ############
@@ -471,6 +1261,10 @@ class Ui:
     # constants from linux/kd.h
     KDSKBMODE = 0x4B45
     K_UNICODE = 0x03
+    KDGKBENT = 0x4B46
+    KDSKBENT = 0x4B47
+    KDGETMODE = 0x4B3B
+    KD_TEXT = 0x00
 
     def __init__(self):
         self.colors = {
@@ -561,16 +1355,93 @@ LANGUAGES = {
     "tr": Language("trq", "lat5u-16", "8859-9", "tr_TR.UTF-8"),
 }
 
+def is_text_console(_file):
+    """Returns True if the console is in text mode, fonts cannot be read or
+    set while a splash holds it in graphics mode."""
+    import fcntl
+
+    mode = struct.unpack("=i", fcntl.ioctl(_file, UI.KDGETMODE, b"\0" * 4))[0]
+    return mode == UI.KD_TEXT
+
+def get_text_console():
+    """Returns the active console, or the first other one in text mode."""
+    consoles = ["/dev/tty0"] + [f"/dev/tty{i}" for i in \
+                                range(1, int(CONFIG.get("tty_number")) + 1)]
+    for console in consoles:
+        try:
+            with open(console, "w") as _file:
+                if is_text_console(_file):
+                    return console
+        except OSError:
+            continue
+    return "/dev/tty0"
+
 def set_console_parameters():
     """Setups encoding, font, and mapping for console."""
     lang = CONFIG.get("language")
     keymap = CONFIG.get("keymap")
     language = LANGUAGES[lang]
+    console = get_text_console()
+
+    bmap, font, keys = CONSOLE_CACHE.load(keymap, language)
+    if bmap is not None and font is not None and keys is not None:
+        import fcntl
+        try:
+            with open("/dev/tty0", "w") as _file:
+                fcntl.ioctl(_file, UI.KDSKBMODE, UI.K_UNICODE)
+                changed = load_binary_keymap(_file.fileno(), bmap)
+                changed += keys.apply(_file.fileno())
+            with open(console, "w") as _file:
+                if ConsoleFont.read(_file.fileno()).to_bytes() != \
+                        font.to_bytes():
+                    font.apply(_file.fileno())
+                    # Select the loaded screen map as G0 like setfont -m
+                    _file.write("\x1b(K")
+            LOGGER.debug(f"Loaded cached console font and keymap on "
+                         f"{console}, {changed} key entries changed")
+            return
+        except (OSError, ValueError) as error:
+            LOGGER.log(f"Cannot load cached console font and keymap: {error}")
 
     # Now actually set the values
     run("/usr/bin/kbd_mode", "-u")
     run_quiet("/bin/loadkeys", keymap)
-    run("/usr/bin/setfont", "-f", language.font, "-m", language.trans)
+    run("/usr/bin/setfont", "-f", language.font, "-m", language.trans,
+        "-C", console)
+    CONSOLE_CACHE.capture(keymap, language, console)
+
+def load_binary_keymap(fd, bmap):
+    """Loads a keymap in the binary format of loadkeys -b, setting only the
+    entries which differ from the kernel's. Returns the number of changed
+    entries."""
+    import fcntl
+
+    header = len(b"bkeymap") + 256
+    if not bmap.startswith(b"bkeymap") or len(bmap) < header:
+        raise ValueError("Invalid binary keymap")
+    # One flag per keymap, followed by the values of each set keymap
+    maps = [index for index, flag in enumerate(bmap[7:header]) if flag]
+    count = (len(bmap) - header) // 2
+    if not maps or count % len(maps):
+        raise ValueError("Invalid binary keymap")
+    values = struct.unpack(f"={count}H", bmap[header:header + count * 2])
+    keys = count // len(maps)
+
+    changed = 0
+    for index, table in enumerate(maps):
+        for key in range(keys):
+            value = values[index * keys + key]
+            entry = struct.pack("=BBH", table, key, 0)
+            if struct.unpack("=BBH", fcntl.ioctl(fd, UI.KDGKBENT,
+                                                 entry))[2] != value:
+                fcntl.ioctl(fd, UI.KDSKBENT,
+                            struct.pack("=BBH", table, key, value))
+                changed += 1
+    return changed
+
+def save_console_cache():
+    """Saves the compiled keymap and console font for the next boots."""
+    CONSOLE_CACHE.save()
 
 def set_system_language():
     """Sets the system language."""
@@ -610,53 +1481,851 @@ def set_unicode_mode():
     lang = CONFIG.get("language")
     language = LANGUAGES[lang]
 
+    # The font loaded by set_console_parameters on the active console is
+    # copied to the others in-process instead of running setfont for each
+    font = None
+    try:
+        with open(get_text_console(), "w") as _file:
+            font = ConsoleFont.read(_file.fileno())
+    except OSError as error:
+        LOGGER.log(f"Cannot read the console font, using setfont: {error}")
+
+    done = []
     for i in range(1, int(CONFIG.get("tty_number")) + 1):  # Python 3'te xrange yerine range kullanılır
         try:
             if os.path.exists(f"/dev/tty{i}"):
                 with open(f"/dev/tty{i}", "w") as _file:
                     fcntl.ioctl(_file, UI.KDSKBMODE, UI.K_UNICODE)
-                    _file.write(UI.UNICODE_MAGIC)
-                    run("/usr/bin/setfont", "-f", language.font, "-m", language.trans, "-C", f"/dev/tty{i}")
+                    # Also select the loaded screen map as G0
+                    _file.write(UI.UNICODE_MAGIC + "\x1b(K")
+                    _file.flush()
+                    if not is_text_console(_file):
+                        # Held by the splash, the font can't be set
+                        LOGGER.debug(f"Not setting the font of graphical "
+                                     f"tty{i}")
+                    elif font:
+                        try:
+                            font.apply(_file.fileno())
+                        except OSError as error:
+                            LOGGER.log(f"Cannot set the font of tty{i}: "
+                                       f"{error}")
+                    else:
+                        run("/usr/bin/setfont", "-f", language.font, "-m", language.trans, "-C", f"/dev/tty{i}")
+                done.append(i)
         except Exception:  # Hataları yakalarken belirli bir istisna yerine genel istisna kullanıldı
             UI.error(_("Could not set unicode mode on tty %d") % i)
+    LOGGER.log("Unicode mode set on ttys %s" % ", ".join(map(str, done)))
+
+
+######################
+# Console font class #
+######################
+
+class ConsoleFont:
+    """Font, unicode map and screen map of a console, read and applied with
+    the ioctls of linux/kd.h."""
+
+    KDFONTOP = 0x4B72
+    KD_FONT_OP_SET = 0
+    KD_FONT_OP_GET = 1
+    GIO_UNIMAP = 0x4B66
+    PIO_UNIMAP = 0x4B67
+    PIO_UNIMAPCLR = 0x4B68
+    GIO_UNISCRNMAP = 0x4B69
+    PIO_UNISCRNMAP = 0x4B6A
+
+    # Upper limits of the kernel, 32 rows of at most 4 bytes per glyph
+    MAX_CHARS = 512
+    MAX_WIDTH = 32
+    MAX_HEIGHT = 32
+
+    def __init__(self, width, height, charcount, data, unimap, scrnmap):
+        self.width = width
+        self.height = height
+        self.charcount = charcount
+        self.data = data
+        # List of (unicode, font position) pairs
+        self.unimap = unimap
+        # 256 unicode values
+        self.scrnmap = scrnmap
+
+    @staticmethod
+    def get_types():
+        """Returns the ctypes structures of the ioctls."""
+        import ctypes
+
+        class FontOp(ctypes.Structure):
+            """struct console_font_op"""
+            _fields_ = [("op", ctypes.c_uint), ("flags", ctypes.c_uint),
+                        ("width", ctypes.c_uint), ("height", ctypes.c_uint),
+                        ("charcount", ctypes.c_uint),
+                        ("data", ctypes.c_void_p)]
+
+        class UniPair(ctypes.Structure):
+            """struct unipair"""
+            _fields_ = [("unicode", ctypes.c_ushort),
+                        ("fontpos", ctypes.c_ushort)]
+
+        class UniMapDesc(ctypes.Structure):
+            """struct unimapdesc"""
+            _fields_ = [("entry_ct", ctypes.c_ushort),
+                        ("entries", ctypes.POINTER(UniPair))]
+
+        class UniMapInit(ctypes.Structure):
+            """struct unimapinit"""
+            _fields_ = [("advised_hashsize", ctypes.c_ushort),
+                        ("advised_hashstep", ctypes.c_ushort),
+                        ("advised_hashlevel", ctypes.c_ushort)]
+
+        return FontOp, UniPair, UniMapDesc, UniMapInit
+
+    @staticmethod
+    def ioctl(fd, request, argument):
+        """Calls ioctl with a pointer argument, raises OSError on failure."""
+        import ctypes
+
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.ioctl(fd, request, argument) < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    @classmethod
+    def read(cls, fd):
+        """Reads the font of the console."""
+        import ctypes
+        import errno
+
+        FontOp, UniPair, UniMapDesc, _ = cls.get_types()
+
+        size = cls.MAX_CHARS * cls.MAX_HEIGHT * (cls.MAX_WIDTH // 8)
+        buf = ctypes.create_string_buffer(size)
+        op = FontOp(cls.KD_FONT_OP_GET, 0, cls.MAX_WIDTH, cls.MAX_HEIGHT,
+                    cls.MAX_CHARS, ctypes.cast(buf, ctypes.c_void_p))
+        cls.ioctl(fd, cls.KDFONTOP, ctypes.byref(op))
+        used = op.charcount * cls.MAX_HEIGHT * ((op.width + 7) // 8)
+        data = buf.raw[:used]
+
+        # Ask for the number of entries first
+        desc = UniMapDesc(0, None)
+        try:
+            cls.ioctl(fd, cls.GIO_UNIMAP, ctypes.byref(desc))
+        except OSError as error:
+            if error.errno != errno.ENOMEM:
+                raise
+        entries = (UniPair * desc.entry_ct)()
+        desc = UniMapDesc(desc.entry_ct, entries)
+        cls.ioctl(fd, cls.GIO_UNIMAP, ctypes.byref(desc))
+        unimap = [(pair.unicode, pair.fontpos) for pair in \
+                  entries[:desc.entry_ct]]
+
+        scrnmap = (ctypes.c_ushort * 256)()
+        cls.ioctl(fd, cls.GIO_UNISCRNMAP, scrnmap)
+
+        return cls(op.width, op.height, op.charcount, data, unimap,
+                   list(scrnmap))
+
+    def apply(self, fd):
+        """Loads the font into the console."""
+        import ctypes
+
+        FontOp, UniPair, UniMapDesc, UniMapInit = self.get_types()
+
+        buf = ctypes.create_string_buffer(self.data, len(self.data))
+        op = FontOp(self.KD_FONT_OP_SET, 0, self.width, self.height,
+                    self.charcount, ctypes.cast(buf, ctypes.c_void_p))
+        self.ioctl(fd, self.KDFONTOP, ctypes.byref(op))
+
+        self.ioctl(fd, self.PIO_UNIMAPCLR, ctypes.byref(UniMapInit(0, 0, 0)))
+        entries = (UniPair * len(self.unimap))(*self.unimap)
+        desc = UniMapDesc(len(self.unimap), entries)
+        self.ioctl(fd, self.PIO_UNIMAP, ctypes.byref(desc))
+
+        self.ioctl(fd, self.PIO_UNISCRNMAP,
+                   (ctypes.c_ushort * 256)(*self.scrnmap))
+
+    def to_bytes(self):
+        """Serializes the font."""
+        pairs = [value for pair in self.unimap for value in pair]
+        return struct.pack(f"=4s5I{len(pairs)}H256H", b"MCFN", self.width,
+                           self.height, self.charcount, len(self.data),
+                           len(self.unimap), *(pairs + self.scrnmap)) + \
+               self.data
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Deserializes a font serialized with to_bytes."""
+        header = struct.Struct("=4s5I")
+        magic, width, height, charcount, size, entries = \
+                header.unpack_from(data)
+        if magic != b"MCFN":
+            raise ValueError("Invalid console font cache")
+        maps = struct.Struct(f"={entries * 2}H256H")
+        if len(data) != header.size + maps.size + size:
+            raise ValueError("Invalid console font cache")
+        values = maps.unpack_from(data, header.size)
+        unimap = list(zip(values[0:entries * 2:2], values[1:entries * 2:2]))
+        return cls(width, height, charcount,
+                   data[header.size + maps.size:], unimap,
+                   list(values[entries * 2:]))
+
+
+class ConsoleKeys:
+    """Dead key table and function key strings of the keyboard, which the
+    binary keymap of loadkeys -b leaves out."""
+
+    KDGKBSENT = 0x4B48
+    KDSKBSENT = 0x4B49
+    KDGKBDIACRUC = 0x4BFA
+    KDSKBDIACRUC = 0x4BFB
+
+    # Limits of the kernel, MAX_DIACR, MAX_NR_FUNC and the kbsentry string
+    MAX_DIACR = 256
+    MAX_FUNC = 256
+    MAX_STRING = 512
+
+    def __init__(self, diacrs, strings):
+        # List of (diacritic, base, result) unicode values
+        self.diacrs = diacrs
+        # Function key number: string
+        self.strings = strings
+
+    @classmethod
+    def read(cls, fd):
+        """Reads the dead keys and function strings of the keyboard."""
+        import fcntl
+
+        buf = bytearray(4 + cls.MAX_DIACR * 12)
+        fcntl.ioctl(fd, cls.KDGKBDIACRUC, buf, True)
+        count = min(struct.unpack_from("=I", buf)[0], cls.MAX_DIACR)
+        values = struct.unpack_from(f"={count * 3}I", buf, 4)
+        diacrs = list(zip(values[0::3], values[1::3], values[2::3]))
+
+        strings = {}
+        for func in range(cls.MAX_FUNC):
+            entry = fcntl.ioctl(fd, cls.KDGKBSENT,
+                                struct.pack(f"=B{cls.MAX_STRING}s", func, b""))
+            string = entry[1:].split(b"\0", 1)[0]
+            if string:
+                strings[func] = string
+        return cls(diacrs, strings)
+
+    def apply(self, fd):
+        """Loads the dead keys and the function strings differing from the
+        kernel's. Returns the number of changed entries."""
+        import fcntl
+
+        current = self.read(fd)
+        changed = 0
+        if current.diacrs != self.diacrs:
+            values = [value for diacr in self.diacrs for value in diacr]
+            buf = bytearray(struct.pack(f"=I{len(values)}I", len(self.diacrs),
+                                        *values))
+            buf.extend(bytes(4 + self.MAX_DIACR * 12 - len(buf)))
+            fcntl.ioctl(fd, self.KDSKBDIACRUC, buf, True)
+            changed += 1
+        for func in range(self.MAX_FUNC):
+            string = self.strings.get(func, b"")
+            if current.strings.get(func, b"") != string:
+                fcntl.ioctl(fd, self.KDSKBSENT,
+                            struct.pack(f"=B{self.MAX_STRING}s", func, string))
+                changed += 1
+        return changed
+
+    def to_bytes(self):
+        """Serializes the dead keys and function strings."""
+        values = [value for diacr in self.diacrs for value in diacr]
+        data = struct.pack(f"=4s2I{len(values)}I", b"MCKB", len(self.diacrs),
+                           len(self.strings), *values)
+        for func, string in sorted(self.strings.items()):
+            data += struct.pack("=BH", func, len(string)) + string
+        return data
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Deserializes the keys serialized with to_bytes."""
+        header = struct.Struct("=4s2I")
+        magic, count, funcs = header.unpack_from(data)
+        if magic != b"MCKB" or count > cls.MAX_DIACR or funcs > cls.MAX_FUNC:
+            raise ValueError("Invalid console keys cache")
+        values = struct.unpack_from(f"={count * 3}I", data, header.size)
+        diacrs = list(zip(values[0::3], values[1::3], values[2::3]))
+        offset = header.size + count * 12
+        strings = {}
+        for _ in range(funcs):
+            func, size = struct.unpack_from("=BH", data, offset)
+            offset += 3
+            if size >= cls.MAX_STRING or offset + size > len(data):
+                raise ValueError("Invalid console keys cache")
+            strings[func] = data[offset:offset + size]
+            offset += size
+        if offset != len(data):
+            raise ValueError("Invalid console keys cache")
+        return cls(diacrs, strings)
+
+
+class ConsoleCache:
+    """Compiled keymaps and console fonts kept in /var/cache/mudur/console
+    per (keymap, font, trans) and the state of their source files."""
+
+    # Search paths and suffixes of the kbd data files
+    KEYMAPS = (("/usr/share/keymaps", "/usr/share/kbd/keymaps",
+                "/lib/kbd/keymaps"),
+               ("", ".map", ".map.gz", ".map.bz2", ".map.xz"))
+    FONTS = (("/usr/share/consolefonts", "/usr/share/kbd/consolefonts",
+              "/lib/kbd/consolefonts"),
+             ("", ".psfu", ".psfu.gz", ".psf", ".psf.gz", ".cp", ".cp.gz",
+              ".fnt", ".fnt.gz", ".gz"))
+    TRANS = (("/usr/share/consoletrans", "/usr/share/kbd/consoletrans",
+              "/lib/kbd/consoletrans"),
+             ("", ".trans", "_to_uni.trans", ".acm", ".acm.gz"))
+
+    SUFFIXES = (".bmap", ".font", ".keys")
+
+    def __init__(self, directory="/var/cache/mudur/console"):
+        self.directory = directory
+        self.pending = {}
+
+    @staticmethod
+    def find_file(name, search):
+        """Returns the data file loadkeys or setfont would use for the name,
+        or None."""
+        roots, suffixes = search
+        if os.path.isabs(name):
+            return name if os.path.isfile(name) else None
+        names = [name + suffix for suffix in suffixes]
+        for root in roots:
+            for path, _, files in os.walk(root):
+                for candidate in names:
+                    if candidate in files:
+                        return os.path.join(path, candidate)
+        return None
+
+    def get_path(self, keymap, language, suffix):
+        """Returns the cache file of the console settings, the name holds the
+        modification times of the keymap, font and screen map so that an
+        updated file is compiled again."""
+        import hashlib
+
+        key = "-".join([keymap, language.font, language.trans])
+        state = []
+        for name, search in ((keymap, self.KEYMAPS),
+                             (language.font, self.FONTS),
+                             (language.trans, self.TRANS)):
+            path = self.find_file(name, search)
+            try:
+                info = os.stat(path) if path else None
+            except OSError:
+                info = None
+            state.append(f"{path}:{info.st_mtime_ns}:{info.st_size}" \
+                         if info else f"{name}:missing")
+        digest = hashlib.sha1("\0".join(state).encode()).hexdigest()[:12]
+        return os.path.join(self.directory,
+                            f"{key.replace('/', '_')}-{digest}{suffix}")
+
+    def load(self, keymap, language):
+        """Returns the cached binary keymap, font and keys, or None for each
+        missing one."""
+        if CONFIG.get("nocache"):
+            return None, None, None
+        bmap = font = keys = None
+        try:
+            base = self.get_path(keymap, language, "")
+            with open(f"{base}.bmap", "rb") as _file:
+                bmap = _file.read()
+            with open(f"{base}.font", "rb") as _file:
+                font = ConsoleFont.from_bytes(_file.read())
+            with open(f"{base}.keys", "rb") as _file:
+                keys = ConsoleKeys.from_bytes(_file.read())
+        except (OSError, ValueError, struct.error):
+            pass
+        return bmap, font, keys
+
+    def capture(self, keymap, language, console="/dev/tty0"):
+        """Compiles the keymap and reads the font, dead keys and function
+        strings loaded by the console tools to save them once the filesystem
+        is writable."""
+        try:
+            bmap = SPAWNER.capture(["/bin/loadkeys", "-b", keymap],
+                                   text=False)[0]
+            with open("/dev/tty0", "w") as _file:
+                keys = ConsoleKeys.read(_file.fileno())
+            with open(console, "w") as _file:
+                font = ConsoleFont.read(_file.fileno())
+        except OSError as error:
+            LOGGER.log(f"Cannot compile console font and keymap: {error}")
+            return
+        if bmap.startswith(b"bkeymap"):
+            base = self.get_path(keymap, language, "")
+            self.pending[f"{base}.bmap"] = bmap
+            self.pending[f"{base}.font"] = font.to_bytes()
+            self.pending[f"{base}.keys"] = keys.to_bytes()
+
+    def save(self):
+        """Writes the captured keymap and font, dropping the stale ones."""
+        if not self.pending:
+            return
+        for path, data in self.pending.items():
+            try:
+                create_directory(self.directory)
+                with open(f"{path}.tmp", "wb") as _file:
+                    _file.write(data)
+                os.rename(f"{path}.tmp", path)
+            except OSError:
+                LOGGER.log(f"Cannot write console cache {path}")
+        try:
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(self.SUFFIXES) and \
+                        entry.path not in self.pending:
+                    os.unlink(entry.path)
+        except OSError:
+            pass
+        self.pending.clear()
 
 
 ######################################
 # Service management related methods #
 ######################################
 
-def fork_handler():
-    """Callback which is passed to Popen as preexec_fn."""
-    import termios
-    import fcntl
+class ComarLink:
+    """Calls COMAR methods over a shared D-Bus connection."""
+
+    address = "tr.org.pardus.comar"
+    interface = "tr.org.pardus.comar"
+
+    # Starting a service may take longer than the default D-Bus timeout
+    timeout = 120
+
+    def __init__(self, bus):
+        import dbus
+
+        self.bus = bus
+        # Without a main loop the replies are waited for one at a time
+        self.blocking = get_glib() is None
+        try:
+            obj = self.bus.get_object(self.address, "/", introspect=False)
+            obj.setLocale(CONFIG.get("language"),
+                          dbus_interface=self.interface)
+        except dbus.DBusException as error:
+            # Only the messages are affected, services can still be managed
+            LOGGER.log(f"Cannot set COMAR locale: {error}")
+
+    def call(self, service, method, reply_handler, error_handler):
+        """Calls the System.Service method of the service asynchronously,
+        the handlers are called from the main loop, or before returning if
+        there is no main loop."""
+        import dbus
+
+        obj = self.bus.get_object(self.address, f"/package/{service}",
+                                  introspect=False)
+        if self.blocking:
+            try:
+                getattr(obj, method)(
+                        dbus_interface=f"{self.interface}.System.Service",
+                        timeout=self.timeout)
+            except dbus.DBusException as error:
+                error_handler(error)
+            else:
+                reply_handler()
+            return
+        getattr(obj, method)(dbus_interface=f"{self.interface}.System.Service",
+                             reply_handler=reply_handler,
+                             error_handler=error_handler,
+                             timeout=self.timeout)
+
+def manage_service(link, service, command, callback=None):
+    """Starts/Stops the given service, callback is called with the service
+    name and the D-Bus error, if any, when COMAR replies."""
+    def reply_handler(*args):
+        """Called when the command succeeds."""
+        LOGGER.debug(f"{command} service {service}..done")
+        if callback:
+            callback(service, None)
+
+    def error_handler(error):
+        """Called when the command fails."""
+        LOGGER.log(f"{command} service {service}..failed: {error}")
+        if callback:
+            callback(service, error)
 
-    # Set umask to a sane value
-    # (other and group has no write permission by default)
-    os.umask(0o22)  # Python 3'te umask değerini 0o ile belirtmek önerilir
-    # Detach from controlling terminal
-    try:
-        tty_fd = os.open("/dev/tty", os.O_RDWR)
-        fcntl.ioctl(tty_fd, termios.TIOCNOTTY)
-        os.close(tty_fd)
-    except OSError:
-        pass
-    # Close IO channels
-    devnull_fd = os.open("/dev/null", os.O_RDWR)
-    os.dup2(devnull_fd, 0)
-    os.dup2(devnull_fd, 1)
-    os.dup2(devnull_fd, 2)
-    # Detach from process group
-    os.setsid()
-
-def manage_service(service, command):
-    """Starts/Stops the given service."""
-    cmd = ["/bin/service", "--quiet", service, command]
     LOGGER.debug(f"{command} service {service}..")
-    subprocess.Popen(cmd, close_fds=True, preexec_fn=fork_handler,
-                     stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    LOGGER.debug(f"{command} service {service}..done")
+    link.call(service, command, reply_handler, error_handler)
     SPLASH.update(service)
 
+def load_service_order(service):
+    """Returns the after, before and requires lists, the readiness protocol
+    ("notify" or "dbus:<name>"), the pidfile, the stop timeout and the
+    cgroup limits of a service."""
+    path = os.path.join("/etc/mudur/services/order", service)
+    order = {"after": [], "before": [], "requires": [], "ready": "",
+             "pidfile": f"/run/{service}.pid", "timeout": "",
+             "cpu_weight": "", "memory_high": "", "io_weight": ""}
+    if os.path.exists(path):
+        for key, value in load_config(path).items():
+            if key in ("ready", "pidfile", "timeout", "cpu_weight",
+                       "memory_high", "io_weight"):
+                order[key] = value
+            elif key in order:
+                order[key] = value.split()
+    return order
+
+
+###########################
+# Readiness monitor class #
+###########################
+
+class ReadinessMonitor:
+    """Learns when services are ready from READY=1 datagrams sent to a
+    notification socket and from D-Bus well-known names getting an owner."""
+
+    def __init__(self, bus, callback, path="/run/mudur/notify"):
+        import socket
+        from gi.repository import GLib
+
+        self.bus = bus
+        self.callback = callback
+        self.path = path
+        self.names = {}
+
+        create_directory(os.path.dirname(path))
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(path)
+        # Services are started by COMAR and don't get mudur's environment,
+        # they find the socket in the well known path, whatever their user
+        os.chmod(path, 0o666)
+        self.source = GLib.io_add_watch(self.sock.fileno(), GLib.IO_IN,
+                                        self.receive)
+        self.receiver = bus.add_signal_receiver(
+                self.name_owner_changed, signal_name="NameOwnerChanged",
+                dbus_interface="org.freedesktop.DBus",
+                bus_name="org.freedesktop.DBus",
+                path="/org/freedesktop/DBus")
+
+    def watch_name(self, name, service):
+        """Considers the service ready when the bus name gets an owner."""
+        self.names[name] = service
+        if self.bus.name_has_owner(name):
+            self.callback(service)
+
+    def name_owner_changed(self, name, old_owner, new_owner):
+        """Signal handler for NameOwnerChanged."""
+        if new_owner and name in self.names:
+            self.callback(self.names[name])
+
+    def receive(self, fd, condition):
+        """Parses a notification, e.g. "READY=1\nSERVICE=<name>"."""
+        data = self.sock.recv(4096).decode("utf-8", "replace")
+        fields = dict([line.split("=", 1) for line in data.splitlines() \
+                       if "=" in line])
+        service = fields.get("SERVICE")
+        if "STATUS" in fields:
+            LOGGER.log(f"Service {service} status: {fields['STATUS']}")
+        if service and fields.get("READY") == "1":
+            self.callback(service)
+        return True
+
+    def close(self):
+        """Stops receiving notifications."""
+        from gi.repository import GLib
+
+        GLib.source_remove(self.source)
+        self.receiver.remove()
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+##########################
+# Service launcher class #
+##########################
+
+class ServiceLauncher:
+    """Runs a service command for a set of services over COMAR, at most jobs
+    of them at the same time, honouring the after/before/requires ordering
+    given in /etc/mudur/services/order/<service>. A service with a ready
+    protocol there counts as finished only when it reports readiness.
+    With reverse, a service waits for the services ordered after it, and
+    with a timeout, a service not finished in time is killed."""
+
+    # Seconds between SIGTERM and SIGKILL
+    KILL_TIMEOUT = 5
+
+    def __init__(self, link, services, command, jobs=1, available=(),
+                 ordered=True, reverse=False, timeout=None):
+        self.link = link
+        self.command = command
+        self.jobs = max(1, jobs)
+        # The given order decides which ready service is launched first
+        self.services = list(services)
+        self.pending = []
+        self.waits = {}
+        self.requires = {}
+        self.status = {}
+        self.errors = {}
+        self.durations = {}
+        self.running = {}
+        self.readiness = {}
+        self.replied = {}
+        self.signaled = set()
+        self.timeout = timeout
+        self.timeouts = {}
+        self.pidfiles = {}
+        self.limits = {}
+        self.deadlines = {}
+        self.killed = {}
+        self.monitor = None
+        self.loop = None
+        self.dispatching = False
+        for service in self.services:
+            self.waits[service] = set()
+            self.requires[service] = set()
+        if ordered:
+            self.load_order(available, reverse)
+
+    def load_order(self, available, reverse=False):
+        """Builds the ordering constraints between the services."""
+        index = 0
+        while index < len(self.services):
+            service = self.services[index]
+            order = load_service_order(service)
+            for other in order["requires"]:
+                # Pull in the required services which are not enabled
+                if other not in self.services and other in available:
+                    self.services.append(other)
+                    self.waits[other] = set()
+                    self.requires[other] = set()
+                if other in self.services:
+                    self.waits[service].add(other)
+                    self.requires[service].add(other)
+                else:
+                    LOGGER.log("Service %s requires unknown service %s" % \
+                            (service, other))
+            for other in order["after"]:
+                if other in self.services:
+                    self.waits[service].add(other)
+            for other in order["before"]:
+                if other in self.services:
+                    self.waits[other].add(service)
+            if order["ready"] and not reverse:
+                self.readiness[service] = order["ready"]
+            if order["timeout"]:
+                try:
+                    self.timeouts[service] = int(order["timeout"])
+                except ValueError:
+                    UI.warn("Invalid timeout %s of service %s, using %s" % \
+                            (order["timeout"], service, self.timeout))
+            self.pidfiles[service] = order["pidfile"]
+            self.limits[service] = dict([(key, order[key]) for key in \
+                    ServiceCgroup.LIMITS])
+            index += 1
+
+        if reverse:
+            # Dependents go first and a failure does not hold others back
+            waits = dict([(service, set()) for service in self.services])
+            for service, others in self.waits.items():
+                for other in others:
+                    waits[other].add(service)
+            self.waits = waits
+            for service in self.services:
+                self.requires[service] = set()
+
+    def get_ready(self):
+        """Returns the pending services whose predecessors are finished."""
+        return [service for service in self.pending \
+                if self.waits[service].issubset(self.status)]
+
+    def launch(self, service):
+        """Launches the service command or skips it if a required service
+        has failed."""
+        self.pending.remove(service)
+        failed = [other for other in self.requires[service] \
+                  if self.status.get(other, 0) != 0]
+        if failed:
+            LOGGER.log("Skipping %s of %s, required %s failed" % \
+                    (self.command, service, ", ".join(failed)))
+            self.status[service] = None
+            return
+        self.running[service] = time.time()
+        ready = self.readiness.get(service, "")
+        if ready.startswith("dbus:"):
+            self.monitor.watch_name(ready[5:], service)
+        if self.timeout is not None:
+            from gi.repository import GLib
+
+            self.deadlines[service] = GLib.timeout_add_seconds(
+                    self.timeouts.get(service, self.timeout),
+                    self.deadline_expired, service)
+        manage_service(self.link, service, self.command, self.finished)
+
+    def deadline_expired(self, service):
+        """Sends SIGTERM to a service which missed its deadline, and SIGKILL
+        if it is still there after KILL_TIMEOUT seconds."""
+        from gi.repository import GLib
+
+        del self.deadlines[service]
+        sig = signal.SIGKILL if service in self.killed else signal.SIGTERM
+        pid = None
+        try:
+            pid = int(load_file(self.pidfiles[service]).split()[0])
+            os.kill(pid, sig)
+        except (KeyError, IndexError, ValueError, OSError):
+            pid = None
+        if pid is None:
+            LOGGER.log(f"Service {service} missed its deadline, no process "
+                       f"to kill")
+            self.killed.setdefault(service, "timeout")
+            self.complete(service, 1)
+            return False
+
+        LOGGER.log(f"Service {service} missed its deadline, sent "
+                   f"{sig.name} to {pid}")
+        self.killed[service] = sig.name
+        if sig == signal.SIGTERM:
+            self.deadlines[service] = GLib.timeout_add_seconds(
+                    self.KILL_TIMEOUT, self.deadline_expired, service)
+        else:
+            self.complete(service, 1)
+        return False
+
+    def finished(self, service, error):
+        """Records the reply of COMAR to a launched service command."""
+        if service not in self.running:
+            # The service was killed before COMAR replied
+            return
+        if error is not None:
+            self.errors[service] = error
+            self.complete(service, 1)
+        elif service not in self.readiness or service in self.signaled:
+            self.complete(service, 0)
+        else:
+            from gi.repository import GLib
+
+            # Wait for the service to report readiness
+            self.replied[service] = GLib.timeout_add_seconds(
+                    CONFIG.get_int("ready_timeout"), self.ready_timeout,
+                    service)
+
+    def ready(self, service):
+        """Called by the readiness monitor when a service is ready."""
+        if service in self.replied:
+            from gi.repository import GLib
+
+            GLib.source_remove(self.replied.pop(service))
+            self.complete(service, 0)
+        elif service in self.running:
+            # Ready before COMAR replied
+            self.signaled.add(service)
+
+    def ready_timeout(self, service):
+        """Stops waiting for the readiness of a service."""
+        LOGGER.log(f"Service {service} did not report readiness in time")
+        del self.replied[service]
+        self.complete(service, 0)
+        return False
+
+    def complete(self, service, status):
+        """Records the result of a service and launches the next ones."""
+        if service in self.deadlines:
+            from gi.repository import GLib
+
+            GLib.source_remove(self.deadlines.pop(service))
+        self.durations[service] = time.time() - self.running.pop(service)
+        self.status[service] = status
+        if status == 0 and self.command != "stop":
+            self.place_in_cgroup(service)
+        self.dispatch()
+
+    def place_in_cgroup(self, service):
+        """Moves a started service from the pidfile into its own cgroup
+        with the limits of its order file, as COMAR forks the services."""
+        try:
+            pid = int(load_file(self.pidfiles.get(service,
+                    f"/run/{service}.pid")).split()[0])
+        except (OSError, IndexError, ValueError):
+            LOGGER.debug(f"No pid for service {service}, not in a cgroup")
+            return
+        cgroup = ServiceCgroup(service)
+        try:
+            errors = cgroup.create(self.limits.get(service, {}))
+        except OSError as error:
+            errors = [str(error)]
+        errors += cgroup.attach(pid)
+        for error in errors:
+            LOGGER.log(f"Service {service} cgroup: {error}")
+
+    def dispatch(self):
+        """Launches the ready services as long as there are free slots."""
+        if self.dispatching:
+            # Called back by a blocking launch, the outer loop goes on
+            return
+        self.dispatching = True
+        try:
+            while True:
+                while len(self.running) < self.jobs:
+                    ready = self.get_ready()
+                    if not ready:
+                        break
+                    self.launch(ready[0])
+                if self.running or not self.pending:
+                    break
+                # Cyclic ordering, break it by the given order
+                LOGGER.log("Cyclic service ordering between %s" % \
+                        ", ".join(self.pending))
+                self.waits[self.pending[0]].clear()
+        finally:
+            self.dispatching = False
+
+        if not self.running and self.loop:
+            self.loop.quit()
+
+    def run(self):
+        """Launches all services and waits for the replies of COMAR."""
+        GLib = get_glib()
+
+        self.pending = list(self.services)
+        if GLib is None or self.link.blocking:
+            # No readiness or deadlines, each call returns when it's done
+            LOGGER.log(f"No GLib main loop, running {self.command} of "
+                       f"services one at a time")
+            self.readiness = {}
+            self.timeout = None
+            self.dispatch()
+            return
+        self.loop = GLib.MainLoop()
+        if self.readiness:
+            self.monitor = ReadinessMonitor(self.link.bus, self.ready)
+        self.dispatch()
+        if self.running:
+            self.loop.run()
+        if self.monitor:
+            self.monitor.close()
+
+    def report(self):
+        """Logs how long each service took and warns about failures."""
+        for service, duration in sorted(self.durations.items(),
+                                        key=lambda x: x[1], reverse=True):
+            LOGGER.log("%s %s: %.2f sec, status %s" % \
+                    (self.command, service, duration, self.status[service]))
+        if self.command == "stop":
+            message = _("Unable to stop %s:")
+        else:
+            message = _("Unable to start %s:")
+        for service in self.services:
+            if service in self.errors:
+                UI.warn("%s\n  %s" % (message % service,
+                                      self.errors[service]))
+        if self.killed:
+            if sys.argv[1] in ("reboot", "shutdown"):
+                UI.warn(_("Services holding up shutdown:"))
+            else:
+                UI.warn(_("Services holding up the %s stage:") % sys.argv[1])
+            for service, how in sorted(self.killed.items()):
+                UI.warn("  %s: %.2f sec, %s" % (service,
+                                               self.durations[service], how))
+
 def get_service_list(bus, _all=False):
     """Requests and returns the list of system services through COMAR."""
     obj = bus.get_object("tr.org.pardus.comar", "/", introspect=False)
@@ -669,39 +2338,57 @@ def get_service_list(bus, _all=False):
         conditional = set(os.listdir("/etc/mudur/services/conditional"))
         return enabled.union(conditional).intersection(set(services))
 
+def get_glib():
+    """Returns the GLib module of PyGObject, None if it is not installed."""
+    try:
+        from gi.repository import GLib
+    except ImportError:
+        return None
+    return GLib
+
+def connect_system_bus():
+    """Connects to the system bus, replies are dispatched by a GLib main
+    loop if PyGObject is installed."""
+    import dbus
+    from dbus.mainloop.glib import DBusGMainLoop
+
+    if get_glib() is None:
+        return dbus.SystemBus()
+    return dbus.SystemBus(mainloop=DBusGMainLoop())
+
 def start_services(extras=None):
     """Sends start signals to the required services through D-Bus."""
     import dbus
 
     os.setuid(0)
     try:
-        bus = dbus.SystemBus()
+        bus = connect_system_bus()
+        link = ComarLink(bus)
     except dbus.DBusException:
         UI.error(_("Cannot connect to DBus, services won't be started"))
         return
 
     if extras:
         # Start only the services given in extras
-        for service in extras:
-            try:
-                manage_service(service, "start")
-            except dbus.DBusException:
-                pass
+        launcher = ServiceLauncher(link, extras, "start",
+                                   CONFIG.get_int("service_jobs"))
+        launcher.run()
+        launcher.report()
 
     else:
         # Start network service first
         try:
-            manage_service("NetworkManager", "ready")
+            manage_service(link, "NetworkManager", "ready")
         except Exception as error:  # Python 3'te as ile değiştirildi
             UI.warn(_("Unable to start network:\n  %s") % error)
 
         # Almost everything depends on logger, so start manually
-        manage_service("rsyslog", "start")
+        manage_service(link, "rsyslog", "start")
         if not wait_bus("/dev/log", stream=False, timeout=15):
             UI.warn(_("Cannot start system logger"))
 
         # Mount remote filesystems if any
-        mount_remote_filesystems()
+        mount_remote_filesystems(link)
 
         if not CONFIG.get("safe"):
             UI.info(_("Starting services"))
@@ -717,20 +2404,25 @@ def start_services(extras=None):
             # Decide whether we'll stop plymouth or not
             stop_plymouth = "off" in get_kernel_option("xorg") or \
                             not run_head_start
+            services = sorted(services)
             if run_head_start:
-                manage_service(head_start, "ready")
                 services.remove(head_start)
+                services.insert(0, head_start)
 
-            # Run other services
-            for service in services:
-                manage_service(service, "ready")
+            # Run the services and wait for them in dependency order
+            launcher = ServiceLauncher(link, services, "ready",
+                                       CONFIG.get_int("service_jobs"),
+                                       get_service_list(bus, _all=True))
+            launcher.run()
+            launcher.report()
 
             if stop_plymouth:
                 # Stop plymouth
                 SPLASH.quit(retain_splash=False)
 
-        # Close the handle
-        bus.close()
+    # Close the handle
+    bus.flush()
+    bus.close()
 
 @plymouth_update_milestone
 def stop_services():
@@ -739,12 +2431,18 @@ def stop_services():
 
     UI.info(_("Stopping services"))
     try:
-        bus = dbus.SystemBus()
+        bus = connect_system_bus()
+        link = ComarLink(bus)
     except dbus.DBusException:
         return
 
-    for service in get_service_list(bus, _all=True):
-        manage_service(service, "stop")
+    # Stop the dependents first, each within its deadline
+    services = sorted(get_service_list(bus, _all=True))
+    launcher = ServiceLauncher(link, services, "stop", len(services),
+                               services, reverse=True,
+                               timeout=CONFIG.get_int("stop_timeout"))
+    launcher.run()
+    launcher.report()
 
     # Close the handle
     bus.close()
@@ -849,8 +2547,9 @@ def start_udev():
     run("/sbin/udevadm", "trigger", "--type=devices", "--action=add")
     run("/sbin/udevadm", "trigger", "--type=devices", "--action=change")
 
-    # Stop udevmonitor
+    # Stop udevmonitor and reap it
     os.kill(pid, 15)
+    SPAWNER.wait(pid)
 
 @skip_for_lxc_guests
 @plymouth_update_milestone
@@ -958,13 +2657,9 @@ def mount_root_filesystem():
     update_mtab_for_root()
 
     # Update mtab
-    for entry in load_file("/proc/mounts").splitlines():
-        try:
-            devpath = entry.split()[1]
-        except IndexError:
-            continue
-        if CONFIG.get_fstab_entry_with_mountpoint(devpath):
-            run("/bin/mount", "-f", "-o", "remount", devpath)
+    for mount in MOUNTS.get_mounts():
+        if CONFIG.get_fstab_entry_with_mountpoint(mount.mountpoint):
+            run("/bin/mount", "-f", "-o", "remount", mount.mountpoint)
 
 @skip_for_lxc_guests
 @plymouth_update_milestone
@@ -973,61 +2668,266 @@ def check_filesystems():
     if not CONFIG.get("live"):
         UI.info(_("Checking all filesystems"))
 
+        # -a: Automatically repair without any questions
+        options = ["-a"]
         if CONFIG.get("forcefsck"):
             SPLASH.hide_splash()
             UI.info(_("A full fsck has been forced"))
-            # -C: Display completion bars
-            # -R: Skip the root file system
-            # -A: Check all filesystems found in /etc/fstab
-            # -a: Automatically repair without any questions
             # -f: Force checking even it's clean (e2fsck)
-            ret = run_full("/sbin/fsck", "-C", "-R", "-A", "-a", "-f")
+            options.append("-f")
+        else:
+            # -T: Don't show the title on startup
+            options.insert(0, "-T")
+
+        ret = 0
+        for passno, checks in get_fsck_passes():
+            LOGGER.log(f"Checking pass {passno}: " + ", ".join(
+                [device for device, disks in checks]))
+            ret |= run_fsck_checks(checks, options)
 
+        if CONFIG.get("forcefsck"):
             # remove forcefsck file if it exists
             if os.path.exists("/forcefsck"):
                 os.unlink("/forcefsck")
-        else:
-            # -T: Don't show the title on startup
-            ret = run_full("/sbin/fsck", "-C", "-T", "-R", "-A", "-a")
 
         if ret == 0:
             pass
-        elif 2 <= ret <= 3:
+        elif 1 <= ret <= 3:
             UI.warn(_("Filesystem errors corrected"))
         else:
             UI.error(_("Fsck could not correct all errors, manual repair needed"))
             run_full("/sbin/sulogin")
 
+def get_block_device(spec):
+    """Resolves an fstab device specification to a device node. udev may
+    not have created the /dev/disk links yet, blkid is asked then."""
+    for key in ("UUID", "LABEL", "PARTUUID", "PARTLABEL"):
+        if spec.startswith(f"{key}="):
+            value = spec[len(key) + 1:].strip("\"")
+            link = f"/dev/disk/by-{key.lower()}/{value}"
+            if os.path.exists(link):
+                return os.path.realpath(link)
+            try:
+                device = capture("/sbin/blkid", "-l", "-o", "device", "-t",
+                                 f"{key}={value}")[0].strip()
+            except OSError:
+                device = ""
+            return device or spec
+    return os.path.realpath(spec)
+
+def has_fsck_helper(fstype):
+    """Returns True if fsck can check the filesystem type, fsck -A skips
+    the types without a fsck.<type> helper."""
+    import shutil
+
+    if fstype == "auto":
+        return True
+    path = ":".join(["/sbin", "/sbin/fs.d", "/sbin/fs", "/etc/fs", "/etc",
+                     os.environ.get("PATH", "")])
+    return shutil.which(f"fsck.{fstype}", path=path) is not None
+
+def get_physical_disks(device):
+    """Returns the names of the disks a block device is stored on, following
+    the slaves of device-mapper and md devices down to whole disks."""
+    name = os.path.basename(device)
+    path = os.path.realpath(f"/sys/class/block/{name}")
+    if not os.path.exists(path):
+        return {name}
+    try:
+        slaves = os.listdir(os.path.join(path, "slaves"))
+    except OSError:
+        slaves = []
+    if slaves:
+        disks = set()
+        for slave in slaves:
+            disks.update(get_physical_disks(slave))
+        return disks
+    if os.path.exists(os.path.join(path, "partition")):
+        # Partitions are below their disk in sysfs
+        return {os.path.basename(os.path.dirname(path))}
+    return {name}
+
+def get_fsck_passes():
+    """Returns the fstab entries to check except the root filesystem, as
+    (spec, disks) tuples grouped by pass number in ascending order. fsck
+    finds the device of the spec itself, the node is only needed to know
+    the disks."""
+    skip = ("proc", "cifs", "nfs", "nfs4", "ncpfs", "swap", "none")
+    passes = {}
+    for entry in CONFIG.get_fstab_entries():
+        if len(entry) < 6 or not entry[5].isdigit() or entry[5] == "0" or \
+                entry[1] == "/" or entry[2] in skip or \
+                "noauto" in entry[3].split(","):
+            continue
+        if not has_fsck_helper(entry[2]):
+            LOGGER.log(f"Skipping fsck of {entry[0]}, no fsck.{entry[2]}")
+            continue
+        passes.setdefault(int(entry[5]), []).append(
+                (entry[0], get_physical_disks(get_block_device(entry[0]))))
+    return sorted(passes.items())
+
+def run_fsck_checks(checks, options):
+    """Runs fsck on the devices concurrently, except devices sharing a disk
+    which are checked one after another. The progress reported by fsck is
+    sent to plymouth. Returns the exit codes of the checks or'ed."""
+    import select
+
+    # Rough share of each e2fsck pass in the check time
+    weights = (0, 70, 10, 10, 5, 5)
+    progress = re.compile(r"^(\d+) (\d+) (\d+) (\S+)$")
+    # One check at a time when serial, select needs at least one to wait on
+    jobs = 1 if CONFIG.get("serial") else max(1, CONFIG.get_int("jobs"))
+    pending = list(checks)
+    running = {}
+    busy = set()
+    ret = 0
+    while pending or running:
+        for device, disks in list(pending):
+            if len(running) >= jobs:
+                break
+            if disks & busy:
+                continue
+            pending.remove((device, disks))
+            busy.update(disks)
+            # -C1: Report the progress on stdout
+            cmd = ["/sbin/fsck", "-C1"] + options + [device]
+            read_fd, write_fd = os.pipe()
+            pid = SPAWNER.spawn(cmd, stdout=write_fd)
+            os.close(write_fd)
+            running[read_fd] = {"device": device, "disks": disks, "pid": pid,
+                                "span": TRACER.begin("command", cmd),
+                                "start": time.monotonic(), "buffer": b"",
+                                "percent": -1}
+        for read_fd in select.select(list(running), [], [])[0]:
+            check = running[read_fd]
+            data = os.read(read_fd, 4096)
+            lines = (check["buffer"] + data).split(b"\n")
+            check["buffer"] = lines.pop() if data else b""
+            for line in lines:
+                line = line.decode("utf-8", "replace")
+                match = progress.match(line.strip())
+                if not match:
+                    if line.strip():
+                        print(line)
+                    continue
+                phase, current, total = [int(value) for value in
+                                         match.groups()[:3]]
+                done = sum(weights[:min(phase, len(weights))])
+                if total and phase < len(weights):
+                    done += weights[phase] * current / total
+                percent = int(100 * done / sum(weights))
+                if percent != check["percent"]:
+                    check["percent"] = percent
+                    SPLASH.update(f"fsck:{check['device']}:{percent}")
+            if data:
+                continue
+            os.close(read_fd)
+            del running[read_fd]
+            busy.difference_update(check["disks"])
+            code = SPAWNER.wait(check["pid"])
+            TRACER.end(check["span"], code)
+            LOGGER.log(f"Checked {check['device']} in "
+                       f"{time.monotonic() - check['start']:.3f} sec, "
+                       f"exit code {code}")
+            # Killed by a signal counts as an operational error
+            ret |= code if code >= 0 else 8
+    return ret
+
 @skip_for_lxc_guests
 @plymouth_update_milestone
 def mount_local_filesystems():
     """Mounts local filesystems."""
 
     UI.info(_("Mounting local filesystems"))
-    run("/bin/mount", "-at", "noproc,nocifs,nonfs,nonfs4,noncpfs")
+    steps = get_mount_steps()
+    if not steps:
+        run("/bin/mount", "-at", "noproc,nocifs,nonfs,nonfs4,noncpfs")
+        return
+    Scheduler(steps, CONFIG.get_int("jobs")).run(
+            serial=CONFIG.get("serial"))
+
+def unescape_mount_path(path):
+    """Decodes the octal escapes of paths in fstab."""
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), path)
+
+def get_mount_steps():
+    """Returns a step for each local filesystem in /etc/fstab which is not
+    mounted yet, requiring the mount of its parent directory, so siblings
+    are mounted concurrently."""
+    remote = ("proc", "cifs", "nfs", "nfs4", "ncpfs", "swap")
+    mounted = set([mount.mountpoint for mount in MOUNTS.get_mounts()])
+
+    entries = {}
+    for entry in CONFIG.get_fstab_entries():
+        if len(entry) < 3:
+            continue
+        options = entry[3].split(",") if len(entry) > 3 else []
+        mountpoint = os.path.normpath(unescape_mount_path(entry[1]))
+        if entry[2] in remote or "noauto" in options or \
+                "_netdev" in options or not mountpoint.startswith("/") or \
+                mountpoint == "/" or mountpoint in mounted:
+            continue
+        entries[mountpoint] = entry
+
+    def get_parent(path):
+        """Returns the closest mount point in fstab containing the path."""
+        while path != "/":
+            path = os.path.dirname(path)
+            if path in entries:
+                return [path]
+        return []
+
+    def mount(mountpoint):
+        """Returns a function mounting the mount point."""
+        def function():
+            start = time.monotonic()
+            ret = run("/bin/mount", mountpoint)
+            LOGGER.log(f"Mounted {mountpoint} in "
+                       f"{time.monotonic() - start:.3f} sec"
+                       f"{'' if ret == 0 else f', failed with {ret}'}")
+        return function
+
+    steps = []
+    for mountpoint, entry in entries.items():
+        requires = get_parent(mountpoint)
+        options = entry[3].split(",") if len(entry) > 3 else []
+        if "bind" in options or "rbind" in options:
+            # The source of a bind mount may be on another filesystem
+            source = os.path.normpath(unescape_mount_path(entry[0]))
+            requires += [source] if source in entries else get_parent(source)
+        steps.append(Step(mountpoint, mount(mountpoint),
+                          requires=[path for path in requires \
+                                    if path != mountpoint]))
+    return steps
+
+def start_log_writer():
+    """Starts appending to mudur.log once /var/log is on its final mount,
+    the records are kept in the ring and the kernel log until then."""
+    LOGGER.start_writer()
 
 @skip_for_lxc_guests
 @plymouth_update_milestone
 def mount_tmpfs_run():
     """Mounts tmpfs on /run."""
-    df = os.popen('df 2>/dev/null', 'r')
-    for line in df.readlines():
-        line = line.strip()
-        if line.startswith("tmpfs") and line.endswith("/run"):
-            UI.info(_("Unmounting /run"))
-            run("/bin/umount", "/run")
-            break
-    df.close()
+    mount = MOUNTS.get("/run")
+    if mount and mount.fstype == "tmpfs":
+        UI.info(_("Unmounting /run"))
+        run("/bin/umount", "/run")
     run_full("/bin/mount", "-t", "tmpfs", "-o", "nodev,nosuid,size=10%,mode=755", "tmpfs", "/run")
-    c = Cgroupfs() 
-
-def mount_remote_filesystems():
+    # Keep the log records in /run from now on
+    LOGGER.attach()
+    cgroupfs = Cgroupfs(CONFIG.get("cgroups") == "unified",
+                        CONFIG.get_int("jobs"))
+    for error in cgroupfs.setup():
+        LOGGER.log(error)
+
+def mount_remote_filesystems(link):
     """Mounts remote filesystems."""
     from pardus.fstabutils import Fstab
     fstab = Fstab()
     if fstab.contains_remote_mounts():
         UI.info(_("Mounting remote filesystems"))
-        manage_service("netfs", "start")
+        manage_service(link, "netfs", "start")
 
 ################################################################################
 # Other system related methods for hostname setting, modules autoloading, etc. #
@@ -1038,6 +2938,20 @@ def minimize_printk_log_level():
     """Decrease kernel console log level for cleaner boot."""
     write_to_file("/proc/sys/kernel/printk", "1")
 
+def setup_localhost():
+    """Brings up the loopback interface."""
+    UI.info(_("Setting up localhost"))
+    run("/sbin/ifconfig", "lo", "127.0.0.1", "up")
+    run("/sbin/route", "add", "-net", "127.0.0.0",
+        "netmask", "255.0.0.0", "gw", "127.0.0.1", "dev", "lo")
+
+def update_environment():
+    """Updates environment variables if /etc/env.d has been modified."""
+    # Check the modification time of the relevant files
+    if mdirtime("/etc/env.d") > mtime("/etc/profile.env"):
+        UI.info(_("Updating environment variables"))
+        run("/sbin/update-environment")
+
 @skip_for_lxc_guests
 def run_sysctl():
     """Applies sysctl.conf rules."""
@@ -1075,16 +2989,62 @@ def set_hostname():
     UI.info(_("Setting up hostname as '%s'") % UI.colorize("light", host))
     run("/bin/hostname", host)
 
+def get_present_modules():
+    """Returns the names of the loaded and built-in kernel modules."""
+    present = set([line.split()[0] for line in \
+                   load_file("/proc/modules").splitlines()])
+    try:
+        # Loaded modules and built-in ones having parameters
+        present.update(os.listdir("/sys/module"))
+    except OSError:
+        pass
+    builtin = load_file("/lib/modules/%s/modules.builtin" % os.uname()[2])
+    for path in builtin.splitlines():
+        name = os.path.basename(path)
+        if name.endswith(".ko"):
+            present.add(name[:-3].replace("-", "_"))
+    return present
+
 @skip_for_lxc_guests
 @plymouth_update_milestone
 def autoload_modules():
     """Traverses /etc/modules.autoload.d to autoload kernel modules if any."""
     if os.path.exists("/proc/modules"):
         import glob
-        for _file in glob.glob("/etc/modules.autoload.d/kernel-%s*" % CONFIG.kernel[0]):
-            data = load_file(_file).splitlines()
-            for module in data:
-                run("/sbin/modprobe", "-q", "-b", module)
+        files = sorted(glob.glob("/etc/modules.autoload.d/kernel-%s*" % \
+                                 CONFIG.kernel[0]))
+        # Drop the modules which are already loaded or built in, the order
+        # in a file is kept as it may decide device numbering. Consecutive
+        # modules without parameters are loaded by a single modprobe -a,
+        # the files are loaded in parallel
+        present = get_present_modules()
+        chains = []
+        for _file in files:
+            chain = []
+            batch = []
+            for line in load_file(_file).splitlines():
+                args = line.split()
+                if not args or args[0].startswith("#") or \
+                        args[0].replace("-", "_") in present:
+                    continue
+                if len(args) == 1:
+                    batch.append(args[0])
+                    continue
+                if batch:
+                    chain.append(["/sbin/modprobe", "-q", "-b", "-a"] + batch)
+                    batch = []
+                chain.append(["/sbin/modprobe", "-q", "-b"] + args)
+            if batch:
+                chain.append(["/sbin/modprobe", "-q", "-b", "-a"] + batch)
+            chains.append(chain)
+        results = SPAWNER.call_many(chains, CONFIG.get_int("jobs"),
+                                    stdout=SPAWNER.get_devnull())
+        for chain, chain_results in zip(chains, results):
+            for cmd, (ret, duration) in zip(chain, chain_results):
+                modules = cmd[4:] if cmd[3] == "-a" else cmd[3:4]
+                LOGGER.log("Loaded %s in %.3f sec%s" % (", ".join(modules),
+                        duration,
+                        "" if ret == 0 else ", modprobe failed (%d)" % ret))
 
 @skip_for_lxc_guests
 def set_disk_parameters():
@@ -1166,10 +3126,29 @@ def cleanup_tmp():
         "/tmp/.X*-lock"
     )
 
-    # Remove directories
-    # Use subprocess instead of os.system for better handling
-    import subprocess
-    subprocess.run(["rm", "-rf"] + list(cleanup_list))
+    # Move the matching entries into a trash directory, they are deleted
+    # in the background after the default runlevel, see empty_tmp_trash
+    import fnmatch
+
+    patterns = [os.path.basename(pattern) for pattern in cleanup_list]
+    trash = os.path.join("/tmp", f"{TMP_TRASH_PREFIX}{time.time_ns()}")
+    moved = 0
+    try:
+        os.mkdir(trash, 0o700)
+        with os.scandir("/tmp") as entries:
+            for entry in entries:
+                if entry.name.startswith(TMP_TRASH_PREFIX) or \
+                        not any([fnmatch.fnmatchcase(entry.name, pattern) \
+                                 for pattern in patterns]):
+                    continue
+                try:
+                    os.rename(entry.path, os.path.join(trash, entry.name))
+                    moved += 1
+                except OSError as error:
+                    LOGGER.log(f"Cannot move {entry.path} to trash: {error}")
+    except OSError as error:
+        LOGGER.log(f"Cannot clean up /tmp: {error}")
+    LOGGER.log(f"Moved {moved} entries from /tmp to {trash}")
 
     create_directory("/tmp/.ICE-unix")
     os.chown("/tmp/.ICE-unix", 0, 0)
@@ -1179,6 +3158,77 @@ def cleanup_tmp():
     os.chown("/tmp/.X11-unix", 0, 0)
     os.chmod("/tmp/.X11-unix", 0o1777)  # Use 0o for octal
 
+def remove_tree(path):
+    """Removes a directory tree without following symlinks, returns the
+    number of entries and bytes removed."""
+    entries = size = 0
+    with os.scandir(path) as children:
+        for child in children:
+            try:
+                if child.is_dir(follow_symlinks=False):
+                    count, total = remove_tree(child.path)
+                    entries += count
+                    size += total
+                else:
+                    size += child.stat(follow_symlinks=False).st_size
+                    os.unlink(child.path)
+                    entries += 1
+            except OSError as error:
+                LOGGER.debug(f"Cannot remove {child.path}: {error}")
+    os.rmdir(path)
+    return entries + 1, size
+
+def empty_tmp_trash():
+    """Deletes the entries moved to trash by cleanup_tmp at the lowest CPU
+    and IO priority and reports what was reclaimed."""
+    from mudur_tmpfiles import set_idle_io_priority
+
+    os.setpriority(os.PRIO_PROCESS, 0, 19)
+    if not set_idle_io_priority():
+        LOGGER.log("Cannot set the idle IO priority to empty /tmp trash")
+    start = time.monotonic()
+    entries = size = 0
+    with os.scandir("/tmp") as trashes:
+        trashes = [entry.path for entry in trashes \
+                   if entry.name.startswith(TMP_TRASH_PREFIX)]
+    for trash in trashes:
+        try:
+            count, total = remove_tree(trash)
+            # The trash directory itself is not counted
+            entries += count - 1
+            size += total
+        except OSError as error:
+            LOGGER.log(f"Cannot empty {trash}: {error}")
+    LOGGER.log(f"Reclaimed {size} bytes in {entries} entries from /tmp in "
+               f"{time.monotonic() - start:.3f} sec")
+    try:
+        LOGGER.flush()
+    except IOError:
+        pass
+
+def start_tmp_trash_cleaner():
+    """Starts emptying the /tmp trash in a detached process, so that the
+    stage can finish without waiting for it."""
+    try:
+        pid = os.fork()
+    except OSError as error:
+        LOGGER.log(f"Cannot start /tmp trash cleaner: {error}")
+        return
+    if pid:
+        # The intermediate child exits at once, init adopts the cleaner
+        os.waitpid(pid, 0)
+        return
+
+    try:
+        os.setsid()
+        if os.fork() == 0:
+            LOGGER.detach()
+            empty_tmp_trash()
+    except BaseException:
+        pass
+    finally:
+        os._exit(0)
+
 ########################################
 # System time/Clock management methods #
 ########################################
@@ -1222,40 +3272,184 @@ def save_clock():
         if ret[1] != '':
             UI.error(_("Failed to synchronize clocks"))
 
+def create_utmp():
+    """Creates utmp and wtmp files."""
+    # When we exit this runlevel, init will write a boot record to utmp
+    write_to_file("/run/utmp")
+    touch("/var/log/wtmp")
+
+    run("/bin/chgrp", "utmp", "/run/utmp", "/var/log/wtmp")
+
+    os.chmod("/run/utmp", 0o664)  # Use octal notation for permissions
+    os.chmod("/var/log/wtmp", 0o664)  # Use octal notation for permissions
+
+def create_static_nodes_conf(path):
+    """Writes the tmpfiles entries of the static device nodes of the kernel
+    modules, replaying the previous output of kmod if possible."""
+    release = os.uname()[2]
+    fingerprint = STEP_CACHE.fingerprint(
+            [f"/lib/modules/{release}/modules.devname"])
+    nodes = STEP_CACHE.lookup("kmod_static_nodes", fingerprint)
+    if nodes is not None:
+        write_to_file(path, nodes)
+        return
+
+    run("/usr/bin/kmod", "static-nodes", "--format=tmpfiles", f"--output={path}")
+    try:
+        with open(path) as _file:
+            STEP_CACHE.store("kmod_static_nodes", fingerprint, _file.read())
+    except OSError:
+        pass
+
+def create_tmpfiles():
+    """Creates volatile and temporary files with mudur_tmpfiles."""
+    UI.info(_("Creating tmpfiles"))
+    if not os.path.isdir("/run/tmpfiles.d"):
+        create_directory("/run/tmpfiles.d")
+    create_static_nodes_conf("/run/tmpfiles.d/kmod.conf")
+    out = [line for line in capture("/sbin/mudur_tmpfiles.py", "--boot")[0].split("\n") if line.strip()]
+    if out:
+        LOGGER.log("Errors during tmpfiles creation.\n\t%s" % "\n\t".join(out))
+    run("mount", "-t", "tmpfs", "tmpfs", "/dev/shm")
+
+def unmount_filesystems(mountpoints):
+    """Unmounts the mount points leaf first, siblings concurrently. A mount
+    point given more than once has stacked mounts, which are unmounted one
+    after another. Returns the mount points which could not be
+    unmounted."""
+    failed = []
+
+    def unmount(mountpoint):
+        """Returns a function unmounting the mount point."""
+        def function():
+            if run_quiet("/bin/umount", mountpoint) != 0:
+                failed.append(mountpoint)
+        return function
+
+    # Step names of each mount point, numbered from the second mount on
+    names = {}
+    for mountpoint in mountpoints:
+        count = len(names.setdefault(mountpoint, []))
+        names[mountpoint].append(f"{mountpoint} ({count + 1})" if count \
+                                 else mountpoint)
+
+    steps = []
+    for mountpoint, stacked in names.items():
+        prefix = mountpoint.rstrip("/") + "/"
+        # Wait for the mounts below, whether they succeed or not
+        requires = [name for other in names if other.startswith(prefix) \
+                    for name in names[other]]
+        for index, name in enumerate(stacked):
+            # The upper mount goes first
+            steps.append(Step(name, unmount(mountpoint),
+                              requires=requires + stacked[:index]))
+    Scheduler(steps, CONFIG.get_int("jobs")).run(
+            serial=CONFIG.get("serial"))
+    return sorted(failed, reverse=True)
+
+def get_open_file_index():
+    """Walks /proc once and returns the pids using each device number
+    through an open file, working or root directory, or a mapping."""
+    index = {}
+    myself = (1, os.getpid(), os.getppid())
+    for pid in [int(name) for name in os.listdir("/proc") if name.isdigit()]:
+        if pid in myself:
+            continue
+        devices = set()
+        paths = ["cwd", "root", "exe"]
+        try:
+            paths += [f"fd/{fd}" for fd in os.listdir(f"/proc/{pid}/fd")]
+        except OSError:
+            pass
+        for path in paths:
+            try:
+                devices.add(os.stat(f"/proc/{pid}/{path}").st_dev)
+            except OSError:
+                pass
+        try:
+            with open(f"/proc/{pid}/maps") as _file:
+                for line in _file:
+                    fields = line.split()
+                    if len(fields) > 5 and fields[4] != "0":
+                        major, minor = fields[3].split(":")
+                        devices.add(os.makedev(int(major, 16),
+                                               int(minor, 16)))
+        except (OSError, ValueError):
+            pass
+        for device in devices:
+            index.setdefault(device, set()).add(pid)
+    return index
+
+def kill_mount_holders(mountpoints, timeout=5):
+    """Kills the processes using the mount points and waits until they are
+    gone or the timeout expires."""
+    import select
+
+    devices = set()
+    for mountpoint in mountpoints:
+        try:
+            devices.add(os.stat(mountpoint).st_dev)
+        except OSError:
+            pass
+    index = get_open_file_index()
+    pids = set()
+    for device in devices:
+        pids.update(index.get(device, ()))
+    if not pids:
+        return
+
+    LOGGER.log(f"Killing processes using {', '.join(mountpoints)}: "
+               f"{' '.join([str(pid) for pid in sorted(pids)])}")
+    pidfds = []
+    for pid in pids:
+        try:
+            # Open the pidfd first, so the pid cannot be reused meanwhile
+            pidfd = os.pidfd_open(pid)
+            signal.pidfd_send_signal(pidfd, signal.SIGKILL)
+            pidfds.append(pidfd)
+        except (AttributeError, OSError):
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    # A pidfd becomes readable when the process exits
+    deadline = time.monotonic() + timeout
+    while pidfds and time.monotonic() < deadline:
+        for pidfd in select.select(pidfds, [], [],
+                                   deadline - time.monotonic())[0]:
+            pidfds.remove(pidfd)
+            os.close(pidfd)
+    for pidfd in pidfds:
+        os.close(pidfd)
+
 def stop_system():
     """Stops the system."""
     import shutil
 
     def get_fs_entries():
-        """Parses and returns /proc/mounts entries."""
+        """Returns the mounts to unmount from the mount table."""
         entries = []
         # Ignore API filesystems
         vfs = ["proc", "devpts", "sysfs", "devtmpfs", "squashfs", 
                "tmpfs", "rootfs", "debugfs", "cgroup", "configfs"]
-        for entry in load_file("/proc/mounts").split("\n"):
-            fields = entry.split()
-            if len(fields) > 2 and fields[2] not in vfs and \
-                    fields[0] != "none" and fields[1] != "/":
-                entries.append(fields)
-        entries.sort(key=lambda x: x[1], reverse=True)
+        for mount in MOUNTS.get_mounts():
+            # Stacked mounts are kept, each needs its own unmount
+            if mount.fstype not in vfs and mount.source != "none" and \
+                    mount.mountpoint != "/":
+                entries.append(mount.mountpoint)
+        entries.sort(reverse=True)
         return entries
 
     def remount_ro(force=False):
         """Remounts the root filesystem read/only."""
-        rootfs = None
-        for entry in load_file("/proc/mounts").split("\n"):
-            fields = entry.split()
-            if len(fields) > 2 and fields[0] != "rootfs" and fields[1] == "/":
-                rootfs = fields
-                break
-
         SPLASH.update("remount_ro")
         SPLASH.quit(retain_splash=True)
         ret = 0
         if force:
-            ret += run_quiet("/bin/umount", "-n", "-r", rootfs[1])
+            ret += run_quiet("/bin/umount", "-n", "-r", "/")
         else:
-            ret += run_quiet("/bin/mount", "-n", "-o", "remount,ro", rootfs[1])
+            ret += run_quiet("/bin/mount", "-n", "-o", "remount,ro", "/")
         if ret:
             run_quiet("/sbin/killall5", "-9")
         return ret
@@ -1273,12 +3467,13 @@ def stop_system():
     if CONFIG.get("lxc_guest") != "yes":
         SPLASH.update("unmount_filesystems")
         UI.info(_("Unmounting filesystems"))
-        for dev in get_fs_entries():
-            if run_quiet("/bin/umount", dev[1]) != 0:
-                # kill processes still using this mount
-                run_quiet("/bin/fuser", "-k", "-9", "-m", dev[1])
-                time.sleep(1)
-                run_quiet("/bin/umount", "-f", "-r", dev[1])
+        mountpoints = get_fs_entries()
+        busy = unmount_filesystems(mountpoints)
+        if busy:
+            # kill processes still using these mounts
+            kill_mount_holders(busy)
+            for mountpoint in unmount_filesystems(busy):
+                run_quiet("/bin/umount", "-f", "-r", mountpoint)
 
         UI.info(_("Remounting remaining filesystems read-only"))
 
@@ -1311,10 +3506,70 @@ def except_hook(e_type, e_value, e_trace):
 
 CONFIG = Config()
 LOGGER = Logger()
+TRACER = Tracer(CONFIG.get("trace"))
+PROFILER = Profiler(CONFIG.get("profile"), CONFIG.get("memprofile"))
+STEP_CACHE = StepCache(enabled=not CONFIG.get("nocache"))
+SPAWNER = Spawner()
+TMP_TRASH_PREFIX = ".mudur-trash-"
+CONSOLE_CACHE = ConsoleCache()
 SPLASH = Plymouth()
 UI = Ui()
 
 
+####################
+# Boot stage steps #
+####################
+
+# Steps run after the root filesystem is remounted read/write. The order of
+# the list is kept when running serially.
+SYSINIT_STEPS = [
+    Step("set_hostname", set_hostname, requires=["root_rw"]),
+    Step("autoload_modules", autoload_modules, requires=["root_rw"],
+         provides=["modules"]),
+    # fsck may drop to sulogin, nothing else should use the console then
+    Step("check_filesystems", check_filesystems, requires=["modules"],
+         exclusive=True),
+    Step("mount_local_filesystems", mount_local_filesystems,
+         requires=["check_filesystems"], provides=["local_fs"]),
+    # A separate /var would hide what is written to mudur.log before
+    Step("start_log_writer", start_log_writer, requires=["local_fs"]),
+    Step("mount_tmpfs_run", mount_tmpfs_run, requires=["local_fs"],
+         provides=["run_mounted"]),
+    Step("enable_swap", enable_swap, requires=["local_fs"]),
+    Step("set_disk_parameters", set_disk_parameters, requires=["modules"]),
+    # hwclock may need rtc modules, fsck should see the old time as before
+    Step("set_clock", set_clock, requires=["modules", "check_filesystems"]),
+    Step("set_system_language", set_system_language, requires=["root_rw"]),
+    Step("save_console_cache", save_console_cache, requires=["local_fs"]),
+    Step("create_utmp", create_utmp, requires=["local_fs", "run_mounted"]),
+    Step("create_tmpfiles", create_tmpfiles,
+         requires=["local_fs", "run_mounted"], provides=["tmpfiles"]),
+    Step("start_udev", start_udev, requires=["modules", "tmpfiles"],
+         provides=["udev_started"]),
+]
+
+BOOT_STEPS = [
+    Step("setup_localhost", setup_localhost),
+    Step("run_sysctl", run_sysctl, requires=["setup_localhost"]),
+    Step("prune_needs_action_package_list", prune_needs_action_package_list),
+    Step("update_environment", update_environment),
+    Step("cleanup_tmp", cleanup_tmp),
+    # DBus starts with the network, environment and /tmp set up
+    Step("start_dbus", start_dbus,
+         requires=["setup_localhost", "run_sysctl", "update_environment",
+                   "cleanup_tmp"]),
+    Step("set_unicode_mode", set_unicode_mode),
+    # Console events of udev should not race the unicode setup
+    Step("wait_for_udev_events", wait_for_udev_events,
+         requires=["set_unicode_mode"]),
+]
+
+def run_steps(steps, facts=()):
+    """Runs the steps of a stage according to the configuration."""
+    scheduler = Scheduler(steps, CONFIG.get_int("jobs"))
+    scheduler.run(facts, serial=CONFIG.get("serial"))
+
+
 def main():
     """Main entry point."""
 
@@ -1333,169 +3588,120 @@ def main():
     # Activate i18n, we can print localized messages from now on
     load_translations()
 
-    ### SYSINIT ###
-    if sys.argv[1] == "sysinit":
-
-        # This is who we are...
-        UI.greet()
-
-        # Now we know which language and keymap to use
-        set_console_parameters()
-
-        # Minimize dmesg noise
-        minimize_printk_log_level()
-
-        # Check root file system
-        check_root_filesystem()
-
-        # Mount root file system
-        mount_root_filesystem()
-        SPLASH.rootfs_is_now_rw()
+    # /run is mounted by sysinit, other stages can keep the log there and
+    # write it in background
+    if sys.argv[1] != "sysinit":
+        LOGGER.attach()
+        LOGGER.start_writer()
 
-        # Set hostname
-        set_hostname()
-
-        # Load modules manually written in /etc/modules.autoload.d/kernel-x.y
-        autoload_modules()
-
-        # Check all filesystems
-        check_filesystems()
-
-        # Mount local filesystems
-        mount_local_filesystems()
-        mount_tmpfs_run()
-
-        # Activate swap space
-        enable_swap()
-
-        # Set disk parameters using hdparm
-        set_disk_parameters()
-
-        # Set the clock
-        set_clock()
-
-        # Set the system language
-        set_system_language()
-
-        # When we exit this runlevel, init will write a boot record to utmp
-        write_to_file("/run/utmp")
-        touch("/var/log/wtmp")
-
-        run("/bin/chgrp", "utmp", "/run/utmp", "/var/log/wtmp")
-
-        os.chmod("/run/utmp", 0o664)  # Use octal notation for permissions
-        os.chmod("/var/log/wtmp", 0o664)  # Use octal notation for permissions
-
-        # Create tmpfiles
-        UI.info(_("Creating tmpfiles"))
-        if not os.path.isdir("/run/tmpfiles.d"):
-            create_directory("/run/tmpfiles.d")
-        run("/usr/bin/kmod", "static-nodes", "--format=tmpfiles", "--output=/run/tmpfiles.d/kmod.conf")
-        out = [line for line in capture("/sbin/mudur_tmpfiles.py", "--boot")[0].split("\n") if line.strip()]
-        if out:
-            LOGGER.log("Errors during tmpfiles creation.\n\t%s" % "\n\t".join(out))
-        run("mount", "-t", "tmpfs", "tmpfs", "/dev/shm")
+    try:
+        ### SYSINIT ###
+        if sys.argv[1] == "sysinit":
 
-        # Start udev and event triggering
-        start_udev()
+            # This is who we are...
+            UI.greet()
 
-    ### BOOT ###
-    elif sys.argv[1] == "boot":
-        SPLASH.update("boot_runlevel")
+            # Now we know which language and keymap to use
+            set_console_parameters()
 
-        UI.info(_("Setting up localhost"))
-        run("/sbin/ifconfig", "lo", "127.0.0.1", "up")
-        run("/sbin/route", "add", "-net", "127.0.0.0",
-            "netmask", "255.0.0.0", "gw", "127.0.0.1", "dev", "lo")
+            # Minimize dmesg noise
+            minimize_printk_log_level()
 
-        run_sysctl()
+            # Check root file system
+            check_root_filesystem()
 
-        # Prune needsrestart and needsreboot files if any
-        prune_needs_action_package_list()
+            # Mount root file system
+            mount_root_filesystem()
+            SPLASH.rootfs_is_now_rw()
 
-        # Update environment variables according to the modification
-        # time of the relevant files
-        if mdirtime("/etc/env.d") > mtime("/etc/profile.env"):
-            UI.info(_("Updating environment variables"))
-            run("/sbin/update-environment")
+            # Hostname, modules, filesystems, clock, language, tmpfiles and udev
+            run_steps(SYSINIT_STEPS, facts=["root_rw"])
 
-        # Cleanup /tmp
-        cleanup_tmp()
+        ### BOOT ###
+        elif sys.argv[1] == "boot":
+            SPLASH.update("boot_runlevel")
 
-        # Start DBUS
-        start_dbus()
+            # Localhost, sysctl, environment, /tmp, DBus, unicode and udev settle
+            run_steps(BOOT_STEPS)
 
-        # Set unicode properties for ttys
-        set_unicode_mode()
+        ### DEFAULT ###
+        elif sys.argv[1] == "default":
+            SPLASH.update("default_runlevel")
 
-        # Call udev settle
-        wait_for_udev_events()
+            # Source local.start
+            if not CONFIG.get("safe") and os.path.exists("/etc/conf.d/local.start"):
+                run("/bin/bash", "/etc/conf.d/local.start")
 
-    ### DEFAULT ###
-    elif sys.argv[1] == "default":
-        SPLASH.update("default_runlevel")
+            # Start services
+            start_services()
 
-        # Source local.start
-        if not CONFIG.get("safe") and os.path.exists("/etc/conf.d/local.start"):
-            run("/bin/bash", "/etc/conf.d/local.start")
+            # Delete what cleanup_tmp moved away now that the services are up
+            start_tmp_trash_cleaner()
 
-        # Start services
-        start_services()
+        ### SINGLE ###
+        elif sys.argv[1] == "single":
+            stop_services()
 
-    ### SINGLE ###
-    elif sys.argv[1] == "single":
-        stop_services()
+        ### REBOOT/SHUTDOWN ###
+        elif sys.argv[1] == "reboot" or sys.argv[1] == "shutdown":
+            SPLASH.start_daemon()
+            SPLASH.rootfs_is_now_rw()
+            SPLASH.show_splash()
 
-    ### REBOOT/SHUTDOWN ###
-    elif sys.argv[1] == "reboot" or sys.argv[1] == "shutdown":
-        SPLASH.start_daemon()
-        SPLASH.rootfs_is_now_rw()
-        SPLASH.show_splash()
+            # Log the operation before unmounting file systems
+            LOGGER.flush()
+            TRACER.save()
 
-        # Log the operation before unmounting file systems
-        LOGGER.flush()
+            # Source local.stop
+            if not CONFIG.get("safe") and os.path.exists("/etc/conf.d/local.stop"):
+                run("/bin/bash", "/etc/conf.d/local.stop")
 
-        # Source local.stop
-        if not CONFIG.get("safe") and os.path.exists("/etc/conf.d/local.stop"):
-            run("/bin/bash", "/etc/conf.d/local.stop")
+            # Load kexec image if any before unmounting filesystems
+            should_kexec = load_kexec_image()
 
-        # Load kexec image if any before unmounting filesystems
-        should_kexec = load_kexec_image()
+            # Stop the system
+            stop_system()
 
-        # Stop the system
-        stop_system()
+            # Control doesn't come back from halting, /run is still mounted
+            PROFILER.save()
 
-        # Try to reboot/shutdown using kexec
-        if should_kexec:
-            kexec_halt()
+            # Try to reboot/shutdown using kexec
+            if should_kexec:
+                kexec_halt()
 
-        if sys.argv[1] == "reboot":
-            # Shut down all network interfaces just before halt or reboot,
-            # When halting the system do a poweroff. This is the default
-            # when halt is called as powerof. Don't write the wtmp record.
-            run("/sbin/reboot", "-idp")
+            if sys.argv[1] == "reboot":
+                # Shut down all network interfaces just before halt or reboot,
+                # When halting the system do a poweroff. This is the default
+                # when halt is called as powerof. Don't write the wtmp record.
+                run("/sbin/reboot", "-idp")
 
-            # Force halt or reboot, don't call shutdown
-            run("/sbin/reboot", "-f")
-        else:
-            run("/sbin/halt", "-ihdp")
-            run("/sbin/halt", "-f")
+                # Force halt or reboot, don't call shutdown
+                run("/sbin/reboot", "-f")
+            else:
+                run("/sbin/halt", "-ihdp")
+                run("/sbin/halt", "-f")
 
-        # Control never reaches here
+            # Control never reaches here
+    finally:
+        # Also when a stage fails
+        PROFILER.save()
 
+    STEP_CACHE.save()
+    SPLASH.flush()
+    LOGGER.log(f"{SPAWNER.count} processes spawned in {sys.argv[1]}")
     try:
         LOGGER.flush()
     except IOError:
         pass
+    TRACER.save()
 
 
 ############################
 # Main program starts here #
 ############################
 if __name__ == "__main__":
-    if "profile" in get_kernel_option("mudur"):
-        import cProfile
-        cProfile.run("main()", f"/dev/.mudur-{sys.argv[1]}.log")  # f-string kullanımı
-    else:
-        main()
+    # mudur=profile[:<msec>] samples the stacks, mudur=memprofile adds
+    # the peak memory of each step
+    PROFILER.start()
+    main()
 
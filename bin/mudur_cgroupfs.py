@@ -1,12 +1,14 @@
 # -*- coding: utf-8 -*-
 import os
-import sys
-import subprocess
+
+from mudur_mounts import MOUNTS, MS_NOSUID, MS_NODEV, MS_NOEXEC, mount
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+CGROUP_FLAGS = MS_NOSUID | MS_NODEV | MS_NOEXEC
 
 def mountpoint(path):
     """Check if the given path is a mountpoint."""
-    result = subprocess.run(["mountpoint", "-q", path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    return result.returncode == 0
+    return MOUNTS.is_mountpoint(path)
 
 class Controller:
     def __init__(self, subsysname, hierarchy, num_cgroups, enabled):
@@ -16,43 +18,48 @@ class Controller:
         self.enabled = enabled
 
     def mount(self):
-        """Mount the cgroup if it is enabled."""
+        """Mount the cgroup if it is enabled, returns an error message or
+        None."""
         if self.enabled == 1:
-            os.chdir("/sys/fs/cgroup")
-            if not mountpoint(self.subsysname):
-                s = self.subsysname
+            s = self.subsysname
+            path = os.path.join(CGROUP_ROOT, s)
+            if not mountpoint(path):
                 try:
-                    os.makedirs(s, exist_ok=True)
-                    result = subprocess.run(
-                        ["mount", "-n", "-t", "cgroup", "-o", s, s],
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE
-                    )
-                    return result.returncode == 0
-                except Exception as e:
-                    print(f"Error mounting cgroup: {e}")
-                    return False
-        return True
+                    os.makedirs(path, exist_ok=True)
+                    mount("cgroup", path, "cgroup", CGROUP_FLAGS, s)
+                except OSError as e:
+                    return f"Error mounting cgroup {s}: {e}"
+        return None
 
 class Cgroupfs:
-    def __init__(self):
-        self.controllers = {}
-        if self.check_fstab():
-            print("cgroupfs in fstab, exiting.")
-            sys.exit(-1)
+    """Mounts the cgroup hierarchies, one per controller in /proc/cgroups or
+    the cgroup2 unified hierarchy with all controllers enabled for its
+    children. Errors are collected in errors instead of exiting."""
 
-        if not self.kernel_support():
-            print("No kernel support for cgroupfs, exiting.")
-            sys.exit(-2)
-
-        if not self.check_sysfs():
-            print("/sys/fs/cgroup directory not found, exiting")
-            sys.exit(-3)
+    def __init__(self, unified=False, jobs=8):
+        self.controllers = {}
+        self.unified = unified
+        self.jobs = max(1, jobs)
+        self.errors = []
 
-        self.mount_cgroup()
-        self.find_controllers()
-        for cname, c in self.controllers.items():
-            c.mount()
+    def setup(self):
+        """Mount the hierarchies, returns the list of errors."""
+        self.errors = []
+        try:
+            if self.check_fstab():
+                self.errors.append("cgroupfs in fstab, skipping")
+            elif not self.kernel_support():
+                self.errors.append("No kernel support for cgroupfs")
+            elif not self.check_sysfs():
+                self.errors.append(f"{CGROUP_ROOT} directory not found")
+            elif self.unified:
+                self.mount_unified()
+            elif self.mount_cgroup():
+                self.find_controllers()
+                self.mount_controllers()
+        except OSError as e:
+            self.errors.append(f"Cannot set up cgroupfs: {e}")
+        return self.errors
 
     def check_fstab(self):
         """Check if cgroup is present in fstab."""
@@ -68,17 +75,25 @@ class Cgroupfs:
 
     def kernel_support(self):
         """Check if the kernel supports cgroups."""
+        if self.unified:
+            with open("/proc/filesystems") as filesystems:
+                return "cgroup2" in filesystems.read().split()
         return os.path.isfile("/proc/cgroups")
 
     def check_sysfs(self):
         """Check if the /sys/fs/cgroup directory exists."""
-        return os.path.isdir("/sys/fs/cgroup")
+        return os.path.isdir(CGROUP_ROOT)
 
     def mount_cgroup(self):
         """Mount the cgroup filesystem if not already mounted."""
-        if not mountpoint("/sys/fs/cgroup"):
-            cmd = "mount -t tmpfs -o uid=0,gid=0,mode=0755 cgroup /sys/fs/cgroup"
-            return os.system(cmd)
+        if not mountpoint(CGROUP_ROOT):
+            try:
+                mount("cgroup", CGROUP_ROOT, "tmpfs", CGROUP_FLAGS,
+                      "uid=0,gid=0,mode=0755")
+            except OSError as e:
+                self.errors.append(f"Error mounting {CGROUP_ROOT}: {e}")
+                return False
+        return True
 
     def find_controllers(self):
         """Read /proc/cgroups and find all controllers."""
@@ -92,3 +107,207 @@ class Cgroupfs:
                 hie = int(hierarchy)
                 numc = int(num_cgroups)
                 self.controllers[subsysname] = Controller(subsysname, hie, numc, enb)
+
+    def mount_controllers(self):
+        """Mount the controllers concurrently, they are independent."""
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=self.jobs,
+                                thread_name_prefix="cgroupfs") as executor:
+            for error in executor.map(Controller.mount,
+                                      self.controllers.values()):
+                if error:
+                    self.errors.append(error)
+
+    def mount_unified(self):
+        """Mount the cgroup2 hierarchy and enable the available controllers
+        in the subtree of the root."""
+        mounted = MOUNTS.get(CGROUP_ROOT)
+        if mounted is None:
+            try:
+                mount("cgroup2", CGROUP_ROOT, "cgroup2", CGROUP_FLAGS)
+            except OSError as e:
+                self.errors.append(f"Error mounting {CGROUP_ROOT}: {e}")
+                return
+        elif mounted.fstype != "cgroup2":
+            self.errors.append(f"{CGROUP_ROOT} is already mounted as "
+                               f"{mounted.fstype}")
+            return
+
+        with open(os.path.join(CGROUP_ROOT, "cgroup.controllers")) as f:
+            controllers = f.read().split()
+        for controller in controllers:
+            # One at a time, so an unavailable one doesn't stop the others
+            try:
+                with open(os.path.join(CGROUP_ROOT, "cgroup.subtree_control"),
+                          "w") as f:
+                    f.write(f"+{controller}")
+            except OSError as e:
+                self.errors.append(f"Cannot enable {controller} controller: "
+                                   f"{e}")
+            else:
+                self.controllers[controller] = Controller(controller, 0, 0, 1)
+
+class ServiceCgroup:
+    """The cgroup of a service under services/ in the cgroup2 hierarchy, or
+    in each mounted controller hierarchy."""
+
+    GROUP = "services"
+    # Limit name: (cgroup2 file, cgroup v1 file, cgroup2 to v1 conversion)
+    LIMITS = {
+        "cpu_weight": ("cpu.weight", "cpu/cpu.shares",
+                       lambda v: str(int(v) * 1024 // 100)),
+        "memory_high": ("memory.high", "memory/memory.soft_limit_in_bytes",
+                        lambda v: v),
+        "io_weight": ("io.weight", "blkio/blkio.weight",
+                      lambda v: str(min(1000, max(10, int(v) // 10)))),
+    }
+
+    def __init__(self, service):
+        self.service = service
+        mounted = MOUNTS.get(CGROUP_ROOT)
+        self.unified = mounted is not None and mounted.fstype == "cgroup2"
+
+    def get_hierarchies(self):
+        """Return the roots of the hierarchies holding service cgroups."""
+        if self.unified:
+            return [CGROUP_ROOT]
+        return [m.mountpoint for m in MOUNTS.get_by_fstype("cgroup") \
+                if os.path.dirname(m.mountpoint) == CGROUP_ROOT]
+
+    def get_paths(self):
+        """Return the cgroup directories of the service."""
+        return [os.path.join(root, self.GROUP, self.service) \
+                for root in self.get_hierarchies()]
+
+    @classmethod
+    def get_services(cls):
+        """Return the services having a cgroup."""
+        services = set()
+        for root in cls("").get_hierarchies():
+            try:
+                for entry in os.scandir(os.path.join(root, cls.GROUP)):
+                    if entry.is_dir():
+                        services.add(entry.name)
+            except OSError:
+                pass
+        return sorted(services)
+
+    def write(self, path, value):
+        """Write a cgroup file, returns an error message or None."""
+        try:
+            with open(path, "w") as f:
+                f.write(value)
+        except (OSError, ValueError) as e:
+            return f"Cannot write {value} to {path}: {e}"
+        return None
+
+    def create(self, limits):
+        """Create the cgroups and apply the limits, a dictionary of LIMITS
+        keys to values. Returns the list of errors."""
+        errors = []
+        if self.unified:
+            group = os.path.join(CGROUP_ROOT, self.GROUP)
+            os.makedirs(group, exist_ok=True)
+            with open(os.path.join(group, "cgroup.controllers")) as f:
+                controllers = f.read().split()
+            for controller in controllers:
+                errors.append(self.write(
+                        os.path.join(group, "cgroup.subtree_control"),
+                        f"+{controller}"))
+        for path in self.get_paths():
+            try:
+                os.makedirs(path, exist_ok=True)
+            except OSError as e:
+                errors.append(f"Cannot create cgroup {path}: {e}")
+        for name, value in limits.items():
+            if not value or name not in self.LIMITS:
+                continue
+            unified, legacy, convert = self.LIMITS[name]
+            if self.unified:
+                path = os.path.join(CGROUP_ROOT, self.GROUP, self.service,
+                                    unified)
+            else:
+                controller, filename = legacy.split("/")
+                path = os.path.join(CGROUP_ROOT, controller, self.GROUP,
+                                    self.service, filename)
+                try:
+                    value = convert(value)
+                except ValueError:
+                    errors.append(f"Invalid {name} value {value}")
+                    continue
+            if os.path.exists(path):
+                errors.append(self.write(path, value))
+            else:
+                errors.append(f"No {name} support, {path} is missing")
+        return [error for error in errors if error]
+
+    def attach(self, pid):
+        """Move the process and its children to the cgroups, returns the
+        list of errors."""
+        pids = [pid]
+        for pid in pids:
+            # Needs CONFIG_PROC_CHILDREN, otherwise only the process moves
+            try:
+                for task in os.listdir(f"/proc/{pid}/task"):
+                    with open(f"/proc/{pid}/task/{task}/children") as f:
+                        pids.extend([int(child) for child in f.read().split()])
+            except OSError:
+                pass
+        errors = []
+        for path in self.get_paths():
+            for pid in pids:
+                errors.append(self.write(os.path.join(path, "cgroup.procs"),
+                                         str(pid)))
+        return [error for error in errors if error]
+
+    def read(self, path):
+        """Return the lines of a cgroup file, an empty list if missing."""
+        try:
+            with open(path) as f:
+                return f.read().splitlines()
+        except OSError:
+            return []
+
+    def stats(self):
+        """Return the CPU time in microseconds, the memory usage and the
+        bytes read and written in bytes and the number of processes."""
+        stats = {"cpu_usec": 0, "memory": 0, "io_read": 0, "io_write": 0,
+                 "tasks": 0}
+        if self.unified:
+            path = os.path.join(CGROUP_ROOT, self.GROUP, self.service)
+            for line in self.read(os.path.join(path, "cpu.stat")):
+                if line.startswith("usage_usec "):
+                    stats["cpu_usec"] = int(line.split()[1])
+            for line in self.read(os.path.join(path, "memory.current")):
+                stats["memory"] = int(line)
+            for line in self.read(os.path.join(path, "io.stat")):
+                for field in line.split()[1:]:
+                    key, value = field.split("=")
+                    if key == "rbytes":
+                        stats["io_read"] += int(value)
+                    elif key == "wbytes":
+                        stats["io_write"] += int(value)
+            stats["tasks"] = len(self.read(os.path.join(path,
+                                                        "cgroup.procs")))
+            return stats
+
+        def legacy(controller, filename):
+            return self.read(os.path.join(CGROUP_ROOT, controller, self.GROUP,
+                                          self.service, filename))
+
+        for line in legacy("cpuacct", "cpuacct.usage"):
+            stats["cpu_usec"] = int(line) // 1000
+        for line in legacy("memory", "memory.usage_in_bytes"):
+            stats["memory"] = int(line)
+        for line in legacy("blkio", "blkio.throttle.io_service_bytes"):
+            fields = line.split()
+            if len(fields) == 3 and fields[1] == "Read":
+                stats["io_read"] += int(fields[2])
+            elif len(fields) == 3 and fields[1] == "Write":
+                stats["io_write"] += int(fields[2])
+        tasks = set()
+        for path in self.get_paths():
+            tasks.update(self.read(os.path.join(path, "cgroup.procs")))
+        stats["tasks"] = len(tasks)
+        return stats
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+In-process mount table built on /proc/self/mountinfo, shared by mudur and
+its helpers instead of running df, mountpoint or reparsing /proc/mounts.
+"""
+
+import os
+import re
+import select
+import threading
+
+# mount(2) flags
+MS_NOSUID = 2
+MS_NODEV = 4
+MS_NOEXEC = 8
+
+def unescape(path):
+    """Decodes the octal escapes the kernel uses for spaces and such."""
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), path)
+
+class Mount:
+    """Dummy class to hold a mountinfo entry."""
+
+    def __init__(self, fields):
+        # Optional fields end with a single "-"
+        separator = fields.index("-", 6)
+        self.mount_id = int(fields[0])
+        self.parent_id = int(fields[1])
+        major, minor = fields[2].split(":")
+        self.device = os.makedev(int(major), int(minor))
+        self.root = unescape(fields[3])
+        self.mountpoint = unescape(fields[4])
+        self.options = fields[5].split(",")
+        self.fstype = fields[separator + 1]
+        self.source = unescape(fields[separator + 2])
+        self.super_options = fields[separator + 3].split(",") \
+                if len(fields) > separator + 3 else []
+
+    def __repr__(self):
+        return f"<Mount {self.source} on {self.mountpoint} ({self.fstype})>"
+
+class MountTable:
+    """Mounts of the namespace indexed by mount point, source and fstype.
+    The file is parsed again only after the kernel signals a change with
+    POLLPRI on the open mountinfo descriptor."""
+
+    def __init__(self, path="/proc/self/mountinfo"):
+        self.path = path
+        self.fd = None
+        self.poller = None
+        self.lock = threading.Lock()
+        self.mounts = []
+        self.by_mountpoint = {}
+        self.by_source = {}
+        self.by_fstype = {}
+
+    def load(self):
+        """Reads and indexes the mount table."""
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        chunks = []
+        while True:
+            data = os.read(self.fd, 65536)
+            if not data:
+                break
+            chunks.append(data)
+        mounts = []
+        for line in b"".join(chunks).decode("utf-8", "replace").splitlines():
+            try:
+                mounts.append(Mount(line.split()))
+            except (ValueError, IndexError):
+                continue
+        self.mounts = mounts
+        self.by_mountpoint = {}
+        self.by_source = {}
+        self.by_fstype = {}
+        for mount in mounts:
+            # Later mounts on the same point cover the earlier ones
+            self.by_mountpoint.setdefault(mount.mountpoint, []).append(mount)
+            self.by_source.setdefault(mount.source, []).append(mount)
+            self.by_fstype.setdefault(mount.fstype, []).append(mount)
+
+    def refresh(self):
+        """Reloads the table if it changed since the last read, the file is
+        opened on first use as /proc may not be mounted before."""
+        with self.lock:
+            if self.fd is None:
+                self.fd = os.open(self.path, os.O_RDONLY | os.O_CLOEXEC)
+                self.poller = select.poll()
+                self.poller.register(self.fd, select.POLLPRI | select.POLLERR)
+                self.load()
+            elif self.poller.poll(0):
+                self.load()
+
+    def get_mounts(self):
+        """Returns all mounts in mount order."""
+        self.refresh()
+        return list(self.mounts)
+
+    def get(self, mountpoint):
+        """Returns the visible mount on the mount point or None."""
+        self.refresh()
+        mounts = self.by_mountpoint.get(os.path.normpath(mountpoint))
+        return mounts[-1] if mounts else None
+
+    def is_mountpoint(self, path):
+        """Returns True if something is mounted on the path."""
+        return self.get(os.path.abspath(path)) is not None
+
+    def get_by_source(self, source):
+        """Returns the mounts of the given source."""
+        self.refresh()
+        return list(self.by_source.get(source, []))
+
+    def get_by_fstype(self, fstype):
+        """Returns the mounts of the given filesystem type."""
+        self.refresh()
+        return list(self.by_fstype.get(fstype, []))
+
+    def close(self):
+        """Closes the mountinfo descriptor."""
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+def mount(source, target, fstype, flags=0, data=None):
+    """Calls mount(2) directly, raises OSError on failure."""
+    import ctypes
+    import ctypes.util
+
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    if libc.mount(source.encode(), target.encode(), fstype.encode(),
+                  ctypes.c_ulong(flags),
+                  data.encode() if data is not None else None) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error), target)
+
+# Shared by all users in the process
+MOUNTS = MountTable()
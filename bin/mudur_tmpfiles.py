@@ -19,6 +19,7 @@ import os
 import re
 import sys
 import stat
+import time
 import shutil
 from pwd import getpwnam
 from grp import getgrnam
@@ -74,12 +75,230 @@ def create(file_type, path, mode, uid, gid, age, arg):
         os.chmod(path, mode)
         os.chown(path, uid, gid)
 
+class NameResolver:
+    """Resolves user and group names from /etc/passwd and /etc/group, which
+    are parsed once, asking NSS only for the names missing there."""
+
+    def __init__(self):
+        self.users = None
+        self.groups = None
+        self.lookups = {"files": 0, "nss": 0}
+        self.elapsed = 0.0
+        self.load_elapsed = 0.0
+
+    def load(self, path):
+        """Return the name to id mapping of a passwd or group file."""
+        start = time.monotonic()
+        ids = {}
+        try:
+            with open(path) as f:
+                for line in f:
+                    fields = line.split(":")
+                    if len(fields) > 2 and fields[2].isdigit():
+                        ids.setdefault(fields[0], int(fields[2]))
+        except OSError:
+            pass
+        self.load_elapsed += time.monotonic() - start
+        return ids
+
+    def resolve(self, name, table, fallback):
+        """Look the name up in the table, then in NSS, raises KeyError."""
+        start = time.monotonic()
+        try:
+            if name in table:
+                self.lookups["files"] += 1
+                return table[name]
+            self.lookups["nss"] += 1
+            return fallback(name)
+        finally:
+            self.elapsed += time.monotonic() - start
+
+    def uid(self, name):
+        """Return the uid of the user."""
+        if self.users is None:
+            self.users = self.load("/etc/passwd")
+        return self.resolve(name, self.users,
+                            lambda name: getpwnam(name).pw_uid)
+
+    def gid(self, name):
+        """Return the gid of the group."""
+        if self.groups is None:
+            self.groups = self.load("/etc/group")
+        return self.resolve(name, self.groups,
+                            lambda name: getgrnam(name).gr_gid)
+
+    def report(self):
+        """Return the parsing and lookup statistics."""
+        return "passwd and group parsed in %.3f ms\n" \
+               "%d user/group lookups, %d from files, %d from NSS in %.3f ms" % (
+            self.load_elapsed * 1000, sum(self.lookups.values()),
+            self.lookups["files"], self.lookups["nss"], self.elapsed * 1000)
+
+# Compiled plan of --boot, see get_plan_key
+PLAN_CACHE = "/var/cache/mudur/tmpfiles.plan"
+PLAN_VERSION = 1
+
+def get_plan_key():
+    """Return a digest of the config directory listings, the mtimes and
+    sizes of the config files and the mtimes of passwd and group. Files in
+    /run are recreated on every boot, so their contents are hashed."""
+    import hashlib
+
+    state = []
+    for head in DEFAULT_CONFIG_DIRS_SO:
+        try:
+            names = sorted(os.listdir(head))
+        except OSError:
+            state.append((head, None))
+            continue
+        for name in names:
+            path = os.path.join(head, name)
+            try:
+                if head.startswith("/run/"):
+                    with open(path, "rb") as f:
+                        state.append((head, name,
+                                      hashlib.sha1(f.read()).hexdigest()))
+                    continue
+                st = os.stat(path)
+            except OSError:
+                continue
+            state.append((head, name, st.st_mtime_ns, st.st_size))
+    for path in ("/etc/passwd", "/etc/group"):
+        try:
+            state.append((path, os.stat(path).st_mtime_ns))
+        except OSError:
+            state.append((path, None))
+    return hashlib.sha1(repr(state).encode()).hexdigest()
+
+def load_plan(key):
+    """Return the cached list of create() arguments if the key matches."""
+    import marshal
+
+    try:
+        with open(PLAN_CACHE, "rb") as f:
+            version, cached_key, plan = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if version != PLAN_VERSION or cached_key != key:
+        return None
+    return plan
+
+def save_plan(key, plan):
+    """Write the list of create() arguments to the cache."""
+    import marshal
+
+    try:
+        os.makedirs(os.path.dirname(PLAN_CACHE), exist_ok=True)
+        with open(PLAN_CACHE + ".tmp", "wb") as f:
+            marshal.dump((PLAN_VERSION, key, plan), f)
+        os.rename(PLAN_CACHE + ".tmp", PLAN_CACHE)
+    except OSError:
+        pass
+
+# Age units in seconds
+AGE_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+# ioprio_set(2) syscall numbers
+IOPRIO_SET = {"x86_64": 251, "i686": 289, "i586": 289, "i386": 289,
+              "aarch64": 30, "armv7l": 314, "armv6l": 314}
+
+def parse_age(age):
+    """Convert an age like "10d" or "1d12h" to seconds, None if empty."""
+    age = age.lstrip("~")
+    if not age:
+        return None
+    parts = re.findall("(\\d+)([smhdw]?)", age)
+    if not parts or "".join([n + u for n, u in parts]) != age:
+        raise ValueError("%s - wrong age" % age)
+    return sum([int(n) * AGE_UNITS[u or "s"] for n, u in parts])
+
+def set_idle_io_priority():
+    """Put the process in the idle IO scheduling class."""
+    import ctypes
+
+    number = IOPRIO_SET.get(os.uname().machine)
+    if number is None:
+        return False
+    # IOPRIO_WHO_PROCESS, this process, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT
+    libc = ctypes.CDLL(None, use_errno=True)
+    return libc.syscall(number, 1, 0, 3 << 13) == 0
+
+def get_busy_directories():
+    """Return the directories holding a file or working directory of some
+    process, and their parents."""
+    busy = set()
+    for pid in [p for p in os.listdir("/proc") if p.isdigit()]:
+        paths = []
+        try:
+            paths.append(os.readlink("/proc/%s/cwd" % pid))
+            for fd in os.listdir("/proc/%s/fd" % pid):
+                paths.append(os.path.dirname(
+                    os.readlink("/proc/%s/fd/%s" % (pid, fd))))
+        except OSError:
+            pass
+        for path in paths:
+            while path.startswith("/") and path not in busy:
+                busy.add(path)
+                path = os.path.dirname(path)
+    return busy
+
+def clean(path, age, busy):
+    """Remove the entries under path whose access, modification and change
+    times are all older than age seconds, staying on the filesystem of
+    path and skipping busy directories. Return the number of removed
+    entries and bytes."""
+    cutoff = time.time() - age
+    flags = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC
+    removed = [0, 0]
+
+    def walk(dir_fd, dirpath, device):
+        with os.scandir(dir_fd) as entries:
+            entries = list(entries)
+        for entry in entries:
+            entrypath = os.path.join(dirpath, entry.name)
+            try:
+                st = entry.stat(follow_symlinks=False)
+                if st.st_dev != device:
+                    continue
+                old = max(st.st_atime, st.st_mtime, st.st_ctime) < cutoff
+                if stat.S_ISDIR(st.st_mode):
+                    if entrypath in busy:
+                        continue
+                    child_fd = os.open(entry.name, flags, dir_fd=dir_fd)
+                    try:
+                        walk(child_fd, entrypath, device)
+                    finally:
+                        os.close(child_fd)
+                    if old:
+                        os.rmdir(entry.name, dir_fd=dir_fd)
+                        removed[0] += 1
+                elif old:
+                    os.unlink(entry.name, dir_fd=dir_fd)
+                    removed[0] += 1
+                    removed[1] += st.st_size
+            except OSError:
+                # Vanished, not empty or not removable, keep going
+                continue
+
+    try:
+        dir_fd = os.open(path, flags)
+    except OSError:
+        return 0, 0
+    try:
+        # Only the subdirectories are skipped when busy
+        walk(dir_fd, path, os.fstat(dir_fd).st_dev)
+    finally:
+        os.close(dir_fd)
+    return tuple(removed)
+
 USAGE = """\
-%s PATH(S)
+%s [--clean] PATH(S)
 \tparsing specified .conf files.
-%s
+%s [--boot | --clean]
 \tparsing .conf files in:
 \t%s
+--clean removes the entries older than the age of d and D lines.
+--debug reports parsing passwd and group and the lookups.
 """ % (sys.argv[0], sys.argv[0], "; ".join(DEFAULT_CONFIG_DIRS_SO))
 
 def usage():
@@ -92,9 +311,30 @@ if __name__ == "__main__":
         usage()
 
     boot = "--boot" in sys.argv
+    cleaning = "--clean" in sys.argv
+    if cleaning:
+        sys.argv.remove("--clean")
+    debug = "--debug" in sys.argv
+    if debug:
+        sys.argv.remove("--debug")
+    resolver = NameResolver()
     config_files = {}
+    cleanups = []
     errors = []
 
+    # With unchanged config, --boot replays the operations of the last boot
+    plan_key = None
+    if boot and not cleaning:
+        plan_key = get_plan_key()
+        plan = load_plan(plan_key)
+        if plan is not None:
+            for fields in plan:
+                create(*fields)
+            if debug:
+                print("Cached plan of %d operations, no lookups" % len(plan))
+            sys.exit(0)
+    plan = []
+
     def add_config_file(head, tail):
         """Add a configuration file to the list."""
         try:
@@ -178,16 +418,43 @@ if __name__ == "__main__":
                     else:
                         fields[2] = int(fields[2], 8)
                     try:
-                        fields[3] = getpwnam(fields[3]).pw_uid
+                        fields[3] = resolver.uid(fields[3])
                     except KeyError:
                         errors.append("User %s does not exist (%s)" % (fields[3], os.path.join(d, f)))
                     try:
-                        fields[4] = getgrnam(fields[4]).gr_gid
+                        fields[4] = resolver.gid(fields[4])
                     except KeyError:
                         errors.append("Group %s does not exist (%s)" % (fields[4], os.path.join(d, f)))
 
+                if cleaning and fields[0] in ["d", "D"]:
+                    try:
+                        age = parse_age(fields[5])
+                    except ValueError as e:
+                        errors.append("%s in file: %s" % (e, os.path.join(d, f)))
+                    else:
+                        if age is not None:
+                            cleanups.append((fields[1], age))
+                    continue
+
                 # Create files/directories as specified
-                if len(errors) == cerr:
+                if len(errors) == cerr and not cleaning:
                     create(*fields)
+                    plan.append(tuple(fields))
+
+    if cleanups:
+        set_idle_io_priority()
+        busy = get_busy_directories()
+        entries = size = 0
+        for path, age in cleanups:
+            count, total = clean(path, age, busy)
+            entries += count
+            size += total
+        print("Removed %d entries, %d bytes" % (entries, size))
+
+    if plan_key and not errors:
+        save_plan(plan_key, plan)
+
+    if debug:
+        print(resolver.report())
 
     print("\n".join(errors))
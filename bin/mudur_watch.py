@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+inotify based waiting for AF_UNIX sockets, shared by mudur and service.
+"""
+
+import os
+import time
+import select
+import socket
+
+# inotify(7) event masks
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+class DirectoryWatch:
+    """Watches a directory for new entries with inotify."""
+
+    def __init__(self, path):
+        import ctypes
+
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = IN_CREATE | IN_MOVED_TO | IN_ATTRIB
+        if libc.inotify_add_watch(self.fd, path.encode(), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"Cannot watch {path}")
+
+    def wait(self, timeout):
+        """Waits until something changes in the directory or timeout."""
+        if select.select([self.fd], [], [], timeout)[0]:
+            try:
+                while os.read(self.fd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        """Closes the inotify descriptor."""
+        os.close(self.fd)
+
+def wait_socket(unix_name, timeout, stream=True):
+    """Waits until a AF_UNIX socket accepts connections for a given
+    duration, trying to connect only when the socket node changes.
+    Returns True if connected."""
+    deadline = time.monotonic() + timeout
+    sock_type = socket.SOCK_STREAM if stream else socket.SOCK_DGRAM
+
+    # Watch before the first attempt so that no creation is missed
+    try:
+        watch = DirectoryWatch(os.path.dirname(unix_name))
+    except OSError:
+        watch = None
+
+    backoff = 0.005
+    try:
+        while True:
+            sock = socket.socket(socket.AF_UNIX, sock_type)
+            try:
+                sock.connect(unix_name)
+                return True
+            except OSError:
+                pass
+            finally:
+                sock.close()
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if watch and not os.path.exists(unix_name):
+                watch.wait(remaining)
+            else:
+                # The node exists but nobody listens yet
+                time.sleep(min(backoff, remaining))
+                backoff = min(backoff * 2, 0.1)
+    finally:
+        if watch:
+            watch.close()
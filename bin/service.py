@@ -12,13 +12,14 @@
 
 import os
 import sys
-import time
 import comar
 import dbus
-import socket
 import locale
 import subprocess
 
+from mudur_cgroupfs import ServiceCgroup
+from mudur_watch import wait_socket
+
 # i18n
 
 import gettext
@@ -41,18 +42,10 @@ def loadConfig(path):
                 d[key] = value
     return d
 
-def waitBus(unix_name, timeout=10, wait=0.1, stream=True):
-    """Wait for a D-Bus socket to become available."""
-    sock_type = socket.SOCK_STREAM if stream else socket.SOCK_DGRAM
-    sock = socket.socket(socket.AF_UNIX, sock_type)
-    while timeout > 0:
-        try:
-            sock.connect(unix_name)
-            return True
-        except OSError:
-            timeout -= wait
-        time.sleep(wait)
-    return False
+def waitBus(unix_name, timeout=10, stream=True):
+    """Wait for a D-Bus socket to become available, trying to connect only
+    when the socket directory changes."""
+    return wait_socket(unix_name, timeout, stream)
 
 # The main part of your program should go here, using the defined functions.
 
@@ -248,6 +241,45 @@ def list_services(use_color=True):
         service_objects = [Service(service, info) for service, info in services]
         format_service_list(service_objects, use_color)
 
+def format_size(size):
+    """Format a byte count for humans."""
+    for unit in ("B", "K", "M", "G"):
+        if size < 1024:
+            break
+        size /= 1024.0
+    return "%.1f%s" % (size, unit) if unit != "B" else "%d%s" % (size, unit)
+
+def print_service_stats(services=None):
+    """Print the CPU, memory and IO usage of the services read from their
+    cgroups, of all services having a cgroup if none is given."""
+    if not services:
+        services = ServiceCgroup.get_services()
+    if not services:
+        print(_("No service cgroups found."))
+        return
+
+    titles = (_("Service"), _("CPU"), _("Memory"), _("Read"), _("Written"),
+              _("Tasks"))
+    rows = []
+    for service in services:
+        stats = ServiceCgroup(service).stats()
+        rows.append((service,
+                     "%.2fs" % (stats["cpu_usec"] / 1000000.0),
+                     format_size(stats["memory"]),
+                     format_size(stats["io_read"]),
+                     format_size(stats["io_write"]),
+                     str(stats["tasks"])))
+    sizes = [max([len(row[i]) for row in rows] + [len(titles[i])]) \
+             for i in range(len(titles))]
+
+    line = " | ".join([title.center(size) for title, size in zip(titles, sizes)])
+    print(line)
+    print("-" * len(line))
+    for row in rows:
+        print(" | ".join([row[0].ljust(sizes[0])] + \
+                         [value.rjust(size) for value, size in \
+                          zip(row[1:], sizes[1:])]))
+
 def manage_service(service, op, use_color=True, quiet=False):
     """Manage a specific service based on the operation provided."""
     operations = {
@@ -262,6 +294,7 @@ def manage_service(service, op, use_color=True, quiet=False):
         "status": lambda s: format_service_list([Service(service, getServiceInfo(service))], use_color),
         "list": lambda s: format_service_list([Service(service, getServiceInfo(service))], use_color),
         "restart": lambda s: (stopService(s, quiet), startService(s, quiet)),
+        "stats": lambda s: print_service_stats([s]),
     }
 
     if op in operations:
@@ -332,13 +365,14 @@ where command is:
  stop     Stop the service
  restart  Stop the service, then start again
  reload   Reload the configuration (if service supports this)
+ stats    Display CPU, memory and IO usage of the service (or all services)
 and option is:
  -N, --no-color  Don't use color in output
  -q, --quiet     Don't print replies"""))
 
 # Main
 def main(args):
-    operations = ("start", "stop", "info", "list", "restart", "reload", "status", "on", "off", "ready", "conditional")
+    operations = ("start", "stop", "info", "list", "restart", "reload", "status", "on", "off", "ready", "conditional", "stats")
     use_color = True
     quiet = False
 
@@ -369,6 +403,10 @@ def main(args):
         usage()
         return 0
 
+    if args[0] == "stats" and len(args) == 1:
+        print_service_stats()
+        return 0
+
     if len(args) < 2:
         usage()
         return 1
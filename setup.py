@@ -65,6 +65,11 @@ def install_file(source, prefix, dest):
     print("installing '%s' to '%s'" % (source, dest))
     os.system("cp %s %s" % (source, dest))
 
+def get_module_dir():
+    """Return the directory of pure Python modules, relative to the root."""
+    import sysconfig
+    return sysconfig.get_path("purelib").lstrip("/")
+
 def install(args):
     if args == []:
         prefix = "/"
@@ -78,7 +83,14 @@ def install(args):
 
     install_file("bin/mudur.py", prefix, "sbin/mudur.py")
     install_file("bin/mudur_tmpfiles.py", prefix, "sbin/mudur_tmpfiles.py")
-    install_file("bin/mudur_cgroupfs.py", prefix, "sbin/mudur_cgroupfs.py")
+    # Shared by mudur and service, so they go where both can import them
+    for module in ("mudur_cgroupfs.py", "mudur_mounts.py", "mudur_watch.py"):
+        install_file("bin/%s" % module, prefix,
+                     os.path.join(get_module_dir(), module))
+        # Older copies in /sbin would shadow them for mudur
+        old = os.path.join(prefix, "sbin", module)
+        if os.path.exists(old):
+            os.unlink(old)
     install_file("bin/update-environment.py", prefix, "sbin/update-environment")
     install_file("bin/update-fstab.py", prefix, "sbin/update-fstab")
     install_file("bin/compat.py", prefix, "etc/init.d/compat.py")